@@ -2,6 +2,13 @@ import sys
 import os
 import csv
 import glob
+import numpy as np
+import par
+
+# WGS84 ellipsoid and UTM scale factor for projecting .all file positions
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+UTM_K0 = 0.9996
 
 # Opens a file and parses out SV strings
 def parse_file(read_file, start_index=0):
@@ -43,6 +50,106 @@ def parse_file(read_file, start_index=0):
     #end for
     return all_data
 
+def read_all_track(read_file):
+    """Return the time, latitude, longitude and SSP of each surface sound
+    speed sample in a Kongsberg .all file, positioned by interpolating the
+    position (80) records at the time of each sound speed (71) sample"""
+    print 'Processing File: ' + read_file
+
+    reader = par.allRead(read_file)
+    if os.path.isfile(read_file[:-3] + 'par'):
+        reader.loadfilemap()
+    else:
+        reader.mapfile()
+        reader.savefilemap()
+    # both types are read straight from the file without decoding records
+    if reader.map.packdir.has_key('71') and reader.map.packdir.has_key('80'):
+        sss = reader.get_all(71)
+        pos = reader.get_all(80, ['Time', 'Latitude', 'Longitude'])
+    else:
+        print 'No sound speed or position records found.'
+        sss = pos = np.zeros(0, dtype=[('Time', 'd'), ('SoundSpeed', 'f'),
+                                       ('Latitude', 'd'), ('Longitude', 'd')])
+    reader.close()
+
+    times = sss['Time']
+    use = (sss['SoundSpeed'] > 0)
+    if len(pos) > 0:
+        use &= (times >= pos['Time'][0]) & (times <= pos['Time'][-1])
+    else:
+        use[:] = False
+    times = times[use]
+    lat = np.interp(times, pos['Time'], pos['Latitude'])
+    lon = np.interp(times, pos['Time'], pos['Longitude'])
+    return times, lat, lon, sss['SoundSpeed'][use].astype(np.float64)
+
+def find_utm_zone(lon):
+    """Return the UTM zone holding the mean of the longitudes"""
+    if len(lon) == 0:
+        return None
+    return int((np.mean(lon) + 180) // 6) % 60 + 1
+
+def latlon_to_utm(lat, lon, utm_zone):
+    """Project latitudes and longitudes in degrees to the easting and
+    northing of the given northern hemisphere UTM zone on WGS84"""
+    e2 = WGS84_F * (2 - WGS84_F)
+    ep2 = e2 / (1 - e2)
+    phi = np.deg2rad(lat)
+    dlon = np.deg2rad(lon - (utm_zone * 6 - 183))
+    dlon = (dlon + np.pi) % (2 * np.pi) - np.pi
+    sin_phi = np.sin(phi)
+    cos_phi = np.cos(phi)
+    n = WGS84_A / np.sqrt(1 - e2 * sin_phi**2)
+    t = np.tan(phi)**2
+    c = ep2 * cos_phi**2
+    a = cos_phi * dlon
+    # meridian arc length (Snyder, Map Projections - A Working Manual, 3-21)
+    m = WGS84_A * ((1 - e2/4 - 3*e2**2/64 - 5*e2**3/256) * phi
+                   - (3*e2/8 + 3*e2**2/32 + 45*e2**3/1024) * np.sin(2*phi)
+                   + (15*e2**2/256 + 45*e2**3/1024) * np.sin(4*phi)
+                   - (35*e2**3/3072) * np.sin(6*phi))
+    x = UTM_K0 * n * (a + (1 - t + c) * a**3 / 6
+                      + (5 - 18*t + t**2 + 72*c - 58*ep2) * a**5 / 120) + 500000
+    y = UTM_K0 * (m + n * np.tan(phi) * (a**2 / 2 + (5 - t + 9*c + 4*c**2) * a**4 / 24
+                  + (61 - 58*t + t**2 + 600*c - 330*ep2) * a**6 / 720))
+    return x, y
+
+def track_to_lines(track, utm_zone, start_index=0):
+    """Return the SSP lines of a track from read_all_track, where each
+    sample runs from the position of the sample before it to its own"""
+    times, lat, lon, ssp = track
+    if len(ssp) == 0:
+        return []
+    x2, y2 = latlon_to_utm(lat, lon, utm_zone)
+    # start each line at the previous position, to avoid breaks in lines
+    x1 = np.append(x2[:1], x2[:-1])
+    y1 = np.append(y2[:1], y2[:-1])
+    ids = np.arange(start_index, start_index + len(ssp))
+    return [list(line) for line in zip(ids, x1, y1, x2, y2, ssp)]
+
+def parse_all_file(read_file, start_index=0, utm_zone=None):
+    """Return the SSP values and associated positions from a Kongsberg .all
+    file, in the same form as parse_file"""
+    track = read_all_track(read_file)
+    if utm_zone is None:
+        utm_zone = find_utm_zone(track[2])
+        if utm_zone is not None:
+            print 'Using UTM zone ' + str(utm_zone)
+    return track_to_lines(track, utm_zone, start_index)
+
+def process_all_files(filenames, out_filename, utm_zone=None):
+    """Join the SSP lines of several .all files in a single data file, in
+    one UTM zone"""
+    tracks = [read_all_track(filename) for filename in filenames]
+    if utm_zone is None:
+        utm_zone = find_utm_zone(np.concatenate([track[2] for track in tracks]))
+        if utm_zone is not None:
+            print 'Using UTM zone ' + str(utm_zone)
+    file_data = []
+    for track in tracks:
+        file_data.extend(track_to_lines(track, utm_zone, len(file_data)))
+    write_data(out_filename, file_data)
+
 def write_data(filename, write_data):
     """Write out a data file given a list of values"""
     wfile = open(filename, 'w')
@@ -58,6 +165,11 @@ def process_single(filename):
     file_data = parse_file(filename)
     write_data(filename[:-3]+'txt', file_data)
 
+def process_single_all(filename, utm_zone=None):
+    """Handle only a single .all file"""
+    file_data = parse_all_file(filename, utm_zone=utm_zone)
+    write_data(filename[:-3]+'txt', file_data)
+
 def main():
     if len(sys.argv) < 2:
         SystemExit(1)
@@ -66,13 +178,26 @@ def main():
     print len(sys.argv), sys.argv
     if look_in.endswith('HSX'):
         process_single(look_in)
-    elif look_in == '-d' and len(sys.argv) == 4:
+    elif look_in.lower().endswith('.all'):
+        # an optional UTM zone may follow
+        if len(sys.argv) == 3:
+            process_single_all(look_in, int(sys.argv[2]))
+        else:
+            process_single_all(look_in)
+    elif look_in == '-d' and len(sys.argv) in (4, 5):
         if os.path.isdir(sys.argv[2]):
             if sys.argv[2][-1] == os.path.sep:
                 dirname = sys.argv[2]
             else:
                 dirname = sys.argv[2] + os.path.sep
 
+            all_files = sorted(glob.glob(dirname+"*.all"))
+            if all_files:
+                if len(sys.argv) == 5:
+                    process_all_files(all_files, sys.argv[3], int(sys.argv[4]))
+                else:
+                    process_all_files(all_files, sys.argv[3])
+                return
             file_data = []
             for cur_file in glob.glob(dirname+"*.HSX"):
                 file_data.extend(list(parse_file(cur_file)))
@@ -80,7 +205,7 @@ def main():
         else:
             print 'A directory must be specified after the -d option.'
     else:
-        print 'You must specify an HSX file or directory to process.'
+        print 'You must specify an HSX or .all file or directory to process.'
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -13,6 +13,13 @@ import struct
 import mmap
 import datetime as dtm
 import pickle
+import multiprocessing
+import threading
+import Queue
+import glob
+import copy
+import time
+from collections import OrderedDict
 import sys, os
 
 try:
@@ -25,24 +32,104 @@ class allRead:
     """
     The class for handling the file.
     """
-    def __init__(self, infilename, verbose = False, byteswap = False):
-        """Make a instance of the allRead class."""
+    
+    # the smallest byte range given to each process when mapping in parallel
+    min_range_size = 1048576
+    # the length word, STX and type at the start of each datagram
+    walk_struct = {False:struct.Struct('<IBB'), True:struct.Struct('>IBB')}
+    # the array of each decoded record type collected by get_all
+    bulk_fields = {65:'data', 68:'data', 71:'data', 78:'rx', 79:'data',
+        85:'data', 88:'data', 102:'rx', 110:'data'}
+    
+    def __init__(self, infilename, verbose = False, byteswap = None, use_mmap = False,
+            lazy = False, cachesize = 0):
+        """
+        Make a instance of the allRead class.  'byteswap' is True for a big
+        endian file and False for a little endian file.  If it is not given
+        the byte order is found from the first datagram.  Set 'use_mmap' to True to
+        memory map the file.  In this mode each datagram is handed to the
+        decoders as a uint8 array view into the mapped file rather than as a
+        copied string, so no data is copied until a decoder converts it.
+        Set 'lazy' to True to have the attitude, surface sound speed, range
+        and angle, XYZ and network attitude decoders return their arrays as
+        scaledarray objects, which convert a field only when it is used.
+        Set 'cachesize' to a number of bytes to keep the records decoded by
+        getrecord in a recordcache of that size, see set_cache.
+        """
         self.infilename = infilename
-        self.byteswap = byteswap
-        # tempfile = open(infilename, 'r+b')
-        # self.infile = mmap.mmap(tempfile.fileno(), 0)
-        # tempfile.close()
+        self.use_mmap = use_mmap
+        self.lazy = lazy
         self.infile = open(infilename, 'rb')
         self.mapped = False
+        self.mapped_to = 0
+        self.mapfilename = ''
         self.packet_read = False
         self.eof = False
         self.error = False
         self.infile.seek(0,2)
         self.filelen = self.infile.tell()
         self.infile.seek(0)
+        if byteswap is None:
+            byteswap = self._detect_byteswap()
+        self.byteswap = byteswap
+        self.filemtime = os.fstat(self.infile.fileno()).st_mtime
+        if self.use_mmap and self.filelen > 0:
+            self._filehandle = self.infile
+            self.infile = mmap.mmap(self._filehandle.fileno(), 0, access = mmap.ACCESS_READ)
+            self.mmbuf = np.frombuffer(self.infile, dtype = np.uint8)
+        else:
+            self.use_mmap = False
+        self.cache = None
+        self.set_cache(cachesize)
+        
+    def set_cache(self, cachesize):
+        """
+        Keeps the records decoded by getrecord, up to about 'cachesize'
+        bytes of them, so that asking for a record again does not read and
+        decode it again.  The least recently used records are dropped first.
+        The cached packets are shared, so they should not be changed.  A
+        size of 0 turns the cache off.
+        """
+        if cachesize > 0:
+            self.cache = recordcache(cachesize)
+        else:
+            self.cache = None
+        
+    def _detect_byteswap(self):
+        """
+        Returns True if the first datagram in the file reads as big endian.
+        A byte order is taken to be right if the length word read in that
+        order points to an ETX at the end of the datagram, following an STX
+        at the start.  Little endian is assumed if neither order fits.
+        """
+        start = self.infile.read(5)
+        byteswap = False
+        if len(start) == 5 and ord(start[4]) == 2:
+            for swapped, fmt in ((False, '<I'), (True, '>I')):
+                packetsize = struct.unpack(fmt, start[:4])[0] + 4
+                if packetsize <= self.filelen:
+                    self.infile.seek(packetsize - 3)
+                    if self.infile.read(1) == '\x03':
+                        byteswap = swapped
+                        break
+        self.infile.seek(0)
+        return byteswap
         
     def close(self):
-        self.infile.close()
+        """
+        Closes the file.  When memory mapped, any arrays still referencing
+        datagrams from this file must not be used after the file is closed.
+        """
+        if self.cache is not None:
+            self.cache.clear()
+        if self.use_mmap:
+            if self.__dict__.has_key('packet'):
+                del self.packet
+            del self.mmbuf
+            self.infile.close()
+            self._filehandle.close()
+        else:
+            self.infile.close()
         
     def read(self):
         """
@@ -51,13 +138,23 @@ class allRead:
         if self.infile.tell() == self.filelen:
                 self.eof = True
         if not self.eof:
-            if self.byteswap:
-                packetsize = 4 + np.fromfile(self.infile, dtype=np.uint32, count=1)[0].newbyteorder()
+            loc = self.infile.tell()
+            if self.use_mmap:
+                packetsize = np.frombuffer(self.mmbuf[loc:loc+4], dtype=np.uint32)[0]
             else:
-                packetsize = 4 + np.fromfile(self.infile, dtype=np.uint32, count=1)[0]
-            self.infile.seek(-4, 1)
-            if self.filelen >= self.infile.tell() + packetsize:
-                self.packet = Datagram(self.infile.read(packetsize), self.byteswap)
+                packetsize = np.fromfile(self.infile, dtype=np.uint32, count=1)[0]
+                self.infile.seek(-4, 1)
+            if self.byteswap:
+                packetsize = packetsize.newbyteorder()
+            packetsize += 4
+            if self.filelen >= loc + packetsize:
+                if self.use_mmap:
+                    self.infile.seek(loc + packetsize)
+                    self.packet = Datagram(self.mmbuf[loc:loc+packetsize], self.byteswap,
+                        self.lazy)
+                else:
+                    self.packet = Datagram(self.infile.read(packetsize), self.byteswap,
+                        self.lazy)
                 self.packet_read = True
                 if not self.packet.valid:
                     self.error = True
@@ -77,28 +174,40 @@ class allRead:
             self.packet.decode()
             self.packet_read = False
         
-    def mapfile(self, verbose = False):
+    def mapfile(self, verbose = False, nproc = 1):
         """
-        Maps the datagrams in the file.
+        Maps the datagrams in the file.  The length prefixed chain of
+        datagrams is walked to collect the offset of each record, and the
+        type and time stamp fields are then pulled from the file for all
+        records at once, so no Datagram objects are made while mapping.
+        Set 'nproc' greater than one to split the file into byte ranges
+        that are mapped by a pool of that many processes.  On Windows this
+        must be called from under an "if __name__ == '__main__'" guard.
         """
-        progress = 0
         if not self.mapped:
             self.map = mappack()
+            if self.cache is not None:
+                self.cache.clear()
             self.reset()
             print 'Mapping file;           ',
-            while not self.eof:
-                loc = self.infile.tell()
-                self.read()
-                dtype = self.packet.header[2]
-                time = self.packet.gettime()
-                self.map.add(str(dtype), loc, time)
-                current = 100 * loc / self.filelen
-                if current - progress >= 1 and verbose:
-                    progress = current
-                    sys.stdout.write('\b\b\b\b\b\b\b\b\b\b%(percent)02d percent' %{'percent':progress})
+            mm, buf = self._open_buffer()
+            if nproc > 1 and self.filelen >= nproc * allRead.min_range_size:
+                locs, end, types, times, valid = self._map_parallel(mm, buf, nproc)
+            else:
+                locs, end = self._scan(mm, 0, self.filelen, verbose)
+                types, times, valid = self._scan_headers(buf, locs, end)
+            del buf
+            self._close_buffer(mm)
+            if end != self.filelen:
+                self.error = True
+                print "Broken packet found at", end
+            if not valid.all():
+                self.error = True
+                print len(valid) - valid.sum(), "records without proper STX or ETX found."
             self.reset()
             # make map into an array and sort by the time stamp
-            self.map.finalize()
+            self.map.add_arrays(types, locs, times)
+            self.mapped_to = end
             if self.error:
                 print
             else:
@@ -108,30 +217,321 @@ class allRead:
             self.mapped = True
         else:
             pass
+            
+    def update_map(self, verbose = False):
+        """
+        Maps only the datagrams added to the file since it was last mapped,
+        for files that are still being logged.  Mapping resumes from the end
+        of the last complete datagram mapped, and a datagram still being
+        written at the end of the file is left for the next update.  The new
+        records are appended to the existing map and, if it has been built,
+        to the navigation array.  A file that has shrunk, or changed without
+        growing, is mapped again in full.  Returns the number of records
+        added, or in the map after mapping again.
+        """
+        if not self.mapped or self.mapped_to is None:
+            self.mapped = False
+            self.mapfile(verbose)
+            return sum([len(v) for v in self.map.packdir.values()])
+        stat = os.fstat(self._fileno())
+        # a truncated or rewritten file no longer matches the map
+        rewritten = stat.st_size < self.filelen or \
+            (stat.st_size == self.filelen and stat.st_mtime != self.filemtime)
+        if not rewritten and stat.st_size <= self.mapped_to:
+            return 0
+        self.filelen = stat.st_size
+        self.filemtime = stat.st_mtime
+        if self.use_mmap and self.filelen > 0:
+            # arrays still holding datagrams keep the old map open until freed
+            if self.__dict__.has_key('packet'):
+                del self.packet
+            self.infile = mmap.mmap(self._filehandle.fileno(), 0, access = mmap.ACCESS_READ)
+            self.mmbuf = np.frombuffer(self.infile, dtype = np.uint8)
+        if rewritten:
+            print 'file ' + self.infilename + ' has changed, mapping it again.'
+            if not self.use_mmap:
+                # drop data read ahead from the old contents
+                self.infile.flush()
+            self.map.close()
+            self.mapped = False
+            self.mapfile(verbose)
+            if self.__dict__.has_key('navarray'):
+                self.navarray = {}
+                for key in ['80', '65', '110']:
+                    if self.map.packdir.has_key(key):
+                        self.navarray[key] = self._build_nav(key)
+            return sum([len(v) for v in self.map.packdir.values()])
+        mm, buf = self._open_buffer()
+        locs, end = self._scan(mm, self.mapped_to, self.filelen, verbose)
+        types, times, valid = self._scan_headers(buf, locs, end)
+        del buf
+        self._close_buffer(mm)
+        if not valid.all():
+            self.error = True
+            print len(valid) - valid.sum(), "records without proper STX or ETX found."
+        counts = dict([(key, len(v)) for key, v in self.map.packdir.items()])
+        resorted = self.map.append_arrays(types, locs, times)
+        if self.cache is not None and len(resorted) > 0:
+            # records of the sorted types have been numbered again
+            self.cache.clear()
+        self.mapped_to = end
+        self.reset()
+        for key in ['80', '65', '110']:
+            # the saved navigation no longer covers the whole map
+            if self.map.aux.has_key('nav' + key):
+                del self.map.aux['nav' + key]
+        for key in self.map.aux.keys():
+            # nor do the position indexes, which are made again when used
+            if key.startswith('geo'):
+                del self.map.aux[key]
+        if self.__dict__.has_key('navarray'):
+            for key in self.navarray.keys():
+                if key in resorted:
+                    self.navarray[key] = self._build_nav(key)
+                elif len(self.map.packdir[key]) > counts[key]:
+                    self.navarray[key] = np.concatenate((self.navarray[key],
+                        self._build_nav(key, counts[key])))
+            for key in ['80', '65', '110']:
+                if self.map.packdir.has_key(key) and not self.navarray.has_key(key):
+                    self.navarray[key] = self._build_nav(key)
+        if verbose:
+            print
+            self.map.printmap()
+        return len(locs)
+        
+    def _open_buffer(self):
+        """
+        Returns the memory mapped file and a uint8 array over it.  If the
+        file was not opened memory mapped a temporary read only map is made,
+        which is closed by _close_buffer.
+        """
+        if self.use_mmap:
+            return self.infile, self.mmbuf
+        elif self.filelen > 0:
+            mm = mmap.mmap(self.infile.fileno(), 0, access = mmap.ACCESS_READ)
+            return mm, np.frombuffer(mm, dtype = np.uint8)
+        else:
+            return '', np.zeros(0, dtype = np.uint8)
+            
+    def _close_buffer(self, mm):
+        """
+        Closes a temporary map made by _open_buffer.  Arrays over the map
+        must not be used afterwards.
+        """
+        if not self.use_mmap and len(mm) > 0:
+            mm.close()
         
-    def loadfilemap(self, mapfilename = ''):
+    def _fileno(self):
+        """
+        Returns the descriptor of the open file.
+        """
+        if self.use_mmap:
+            return self._filehandle.fileno()
+        else:
+            return self.infile.fileno()
+        
+    def _map_parallel(self, mm, buf, nproc):
+        """
+        Splits the file into 'nproc' byte ranges and maps them in a process
+        pool.  Each worker starts at the first valid datagram it can find in
+        its range, so the ranges are checked to chain onto each other when
+        merged.  A range whose first datagram is not where the previous
+        range ended is walked again here from the end of the previous range.
+        """
+        bounds = np.linspace(0, self.filelen, nproc + 1).astype(np.int64)
+        tasks = [(self.infilename, self.byteswap, bounds[n], bounds[n+1])
+            for n in range(nproc)]
+        pool = multiprocessing.Pool(nproc)
+        try:
+            results = pool.map(_map_range, tasks)
+        finally:
+            pool.close()
+            pool.join()
+        parts = []
+        expected = 0
+        for stop, result in zip(bounds[1:], results):
+            first, end = result[:2]
+            if first != expected:
+                locs, end = self._scan(mm, expected, stop)
+                types, times, valid = self._scan_headers(buf, locs, end)
+                result = (expected, end, locs, types, times, valid)
+            parts.append(result[2:])
+            expected = end
+        locs, types, times, valid = [np.concatenate(part) for part in zip(*parts)]
+        return locs, expected, types, times, valid
+        
+    def _resync(self, start, stop):
+        """
+        Finds the offset of the first valid datagram at or after 'start' in
+        the memory mapped file.  A candidate must have the STX byte, a
+        length word that lands on an ETX byte, a plausible date, and be
+        followed by another datagram with an STX byte or the end of file.
+        If none is found before 'stop', 'stop' is returned.
+        """
+        buf = self.mmbuf
+        window = 65536
+        lo = start
+        while lo < stop:
+            hi = min(lo + window, stop)
+            candidates = np.nonzero(buf[lo+4:hi+4] == 2)[0] + lo
+            for p in candidates:
+                if self._isdatagram(p):
+                    size = self._gather_uint(buf, [p], 4)[0] + 4
+                    q = p + size
+                    if q == self.filelen or (q + 4 < self.filelen and buf[q+4] == 2):
+                        return p
+            lo = hi
+        return stop
+        
+    def _isdatagram(self, p):
+        """
+        Checks whether a valid datagram header starts at byte 'p' of the
+        memory mapped file.
+        """
+        buf = self.mmbuf
+        if p + 16 > self.filelen or buf[p+4] != 2:
+            return False
+        size = self._gather_uint(buf, [p], 4)[0] + 4
+        if size < 19 or p + size > self.filelen or buf[p+size-3] != 3:
+            return False
+        date = self._gather_uint(buf, [p+8], 4)[0]
+        return 19700101 <= date <= 21991231
+        
+    def _scan(self, buf, start, stop, verbose = False):
+        """
+        Walks the chain of datagram length words in the buffer (a string or
+        mmap of the file) from byte 'start' and returns an array of the
+        offset of each complete datagram beginning before byte 'stop', and
+        the offset following the last complete datagram.
+        """
+        if self.byteswap:
+            unpack = struct.Struct('>I').unpack_from
+        else:
+            unpack = struct.Struct('<I').unpack_from
+        filelen = len(buf)
+        locs = []
+        p = start
+        report = start
+        step = max(filelen // 100, 1)
+        while p < stop and p + 4 <= filelen:
+            packetsize = unpack(buf, p)[0] + 4
+            if p + packetsize > filelen:
+                break
+            locs.append(p)
+            p += packetsize
+            if verbose and p >= report:
+                report += step
+                sys.stdout.write('\b\b\b\b\b\b\b\b\b\b%(percent)02d percent' %{'percent':100 * p // filelen})
+        return np.asarray(locs, dtype = np.int64), p
+        
+    def _scan_headers(self, buf, locs, end):
+        """
+        Reads the type byte and the date and time fields of the datagrams
+        at the offsets in 'locs' from the uint8 array 'buf' and converts the
+        times to POSIX time stamps, returning the types, the times and
+        whether each datagram has its STX and ETX.  'end' is the offset
+        following the last datagram.
+        """
+        types = buf[locs + 5]
+        date = self._gather_uint(buf, locs + 8, 4)
+        ms = self._gather_uint(buf, locs + 12, 4)
+        # the ETX is the third to last byte before the next datagram
+        ends = np.append(locs[1:], end)
+        valid = (buf[locs + 4] == 2) & (buf[ends - 3] == 3)
+        year = (date // 10000).astype(np.int64)
+        month = (date // 100 % 100).astype(np.int64)
+        day = (date % 100).astype(np.int64)
+        gooddate = (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31)
+        month[~gooddate] = 1
+        day[~gooddate] = 1
+        dates = (year - 1970).astype('datetime64[Y]') + (month - 1).astype('timedelta64[M]')
+        dates = dates.astype('datetime64[D]') + (day - 1).astype('timedelta64[D]')
+        numdays = dates.astype(np.int64)
+        times = numdays * 24 * 60 * 60 + ms * 0.001
+        times[~gooddate] = np.nan
+        return types, times, valid
+        
+    def _gather_uint(self, buf, idx, nbytes):
+        """
+        Assembles the unsigned integers of 'nbytes' bytes found at the
+        offsets 'idx' in the uint8 array 'buf', honoring the byteswap flag.
+        """
+        idx = np.asarray(idx)
+        val = np.zeros(len(idx), dtype = np.uint32)
+        for n in range(nbytes):
+            if self.byteswap:
+                shift = 8 * (nbytes - 1 - n)
+            else:
+                shift = 8 * n
+            val |= buf[idx + n].astype(np.uint32) << shift
+        return val
+        
+    def loadfilemap(self, mapfilename = '', rebuild = True):
         """
         Loads the packdir if the map object packdir has been saved previously.
+        The index is memory mapped rather than read.  If the size or
+        modification time of this file no longer match those recorded in the
+        index, or the map was saved in the old pickled form, the file is
+        mapped again and the index rewritten unless 'rebuild' is False.  The
+        new map is kept in memory if the index cannot be rewritten.
         """
         if mapfilename == '':
             mapfilename = self.infilename[:-3] + 'par'
+        if self.cache is not None:
+            self.cache.clear()
         try:
             self.map = mappack()
             self.map.load(mapfilename)
             self.mapped = True
+            self.mapfilename = mapfilename
+            if self.map.aux.has_key('mapped_to'):
+                self.mapped_to = int(self.map.aux['mapped_to'][0])
+            else:
+                self.mapped_to = None
             print 'loaded file map ' + mapfilename
         except IOError:
             print mapfilename + ' map file not found.'
+            return
+        if rebuild and self.map.is_stale(self.filelen, self.filemtime):
+            print 'file map ' + mapfilename + ' is out of date, rebuilding.'
+            if self.__dict__.has_key('navarray'):
+                del self.navarray
+            self.map.close()
+            self.mapped = False
+            self.mapfile()
+            self._save_map(mapfilename)
+            
+    def _save_map(self, mapfilename = ''):
+        """
+        Saves the file map as savefilemap does, keeping it in memory only if
+        the index file cannot be written, such as for read only data.
+        """
+        try:
+            self.savefilemap(mapfilename)
+        except (IOError, OSError):
+            print 'unable to save the map for ' + self.infilename
             
-    def savefilemap(self):
+    def savefilemap(self, mapfilename = ''):
         """
         Saves the mappack packdir dictionary for faster operations on a file in
         the future.  The file is saved under the same name as the loaded file
-        but with a 'par' extension.
+        but with a 'par' extension.  The navigation array is saved with it
+        if it has been built.
         """
         if self.mapped:
-            mapfilename = self.infilename[:-3] + 'par'
-            self.map.save(mapfilename)
+            if mapfilename == '':
+                mapfilename = self.infilename[:-3] + 'par'
+            if self.mapped_to is not None:
+                self.map.aux['mapped_to'] = np.array([self.mapped_to], dtype = np.int64)
+            if self.__dict__.has_key('navarray'):
+                for key in self.navarray.keys():
+                    self.map.aux['nav' + key] = self.navarray[key]
+            self.map.save(mapfilename, self.filelen, self.filemtime)
+            if self.__dict__.has_key('navarray'):
+                # saving moves memory mapped arrays into memory
+                for key in self.navarray.keys():
+                    self.navarray[key] = self.map.aux['nav' + key]
+            self.mapfilename = mapfilename
             print 'file map saved to ' + mapfilename
         else:
             print 'no map to save.'
@@ -139,18 +539,196 @@ class allRead:
         
     def getrecord(self, recordtype, recordnum):
         """
-        Gets the record number of the described record type.
+        Gets the record number of the described record type.  The record is
+        taken from the cache if there is one holding it.  Either way the file
+        is left positioned after the record, so read and findpacket carry on
+        from there.
         """
         if not self.mapped:
             self.mapfile()
         if self.map.packdir.has_key(str(recordtype)):
-            loc = self.map.packdir[str(recordtype)][recordnum][0]
+            records = self.map.packdir[str(recordtype)]
+            loc = int(records[recordnum][0])
+            self.eof = False
+            if self.cache is not None:
+                key = (int(recordtype), int(recordnum) % len(records))
+                packet = self.cache.get(key)
+                if packet is not None:
+                    self.packet = packet
+                    self.packet_read = False
+                    self.infile.seek(loc + 4 + int(packet.header['Bytes']))
+                    return
             self.infile.seek(loc)
             self.read()
             self.get()
+            if self.cache is not None and self.packet.decoded:
+                self.cache.put(key, self.packet)
         else:
             print "record " + str(recordtype) + " not available."
             
+    def getrecords_between(self, recordtype, t0, t1):
+        """
+        Returns the numbers of the records of the given type with time
+        stamps from t0 through t1, for use with getrecord.
+        """
+        if not self.mapped:
+            self.mapfile()
+        return self.map.getrecords_between(recordtype, t0, t1)
+        
+    def nearest_record(self, recordtype, tstamp, tolerance = None):
+        """
+        Returns the number of the record of the given type nearest in time
+        to the time stamp, or -1 if there is none within the tolerance in
+        seconds.
+        """
+        if not self.mapped:
+            self.mapfile()
+        return self.map.nearest_record(recordtype, tstamp, tolerance)
+        
+    def nearest_records(self, recordtype, tstamps, tolerance = None):
+        """
+        Returns the numbers of the records of the given type nearest in time
+        to each of an array of time stamps, with -1 where there is none
+        within the tolerance in seconds.
+        """
+        if not self.mapped:
+            self.mapfile()
+        return self.map.nearest_records(recordtype, tstamps, tolerance)
+        
+    def getrecords_in_box(self, recordtype, lat0, lat1, lon0, lon1):
+        """
+        Returns the numbers of the records of the given type positioned
+        within latitudes lat0 through lat1 and longitudes lon0 through lon1,
+        in degrees, for use with getrecord.  The position index of the type
+        is made by build_geoindex the first time it is needed, and is saved
+        with the map if the map has been loaded from or saved to a file.
+        """
+        if not self.mapped:
+            self.mapfile()
+        if not self.map.aux.has_key('geo' + str(int(recordtype))):
+            self.build_geoindex(recordtype, save = self.mapfilename != '')
+        return self.map.getrecords_in_box(recordtype, lat0, lat1, lon0, lon1)
+        
+    def get_all(self, recordtype, fields = None):
+        """
+        Decodes every record of the given type and returns the results
+        concatenated into a single structured array, in the same units as
+        the record decoders.  Attitude (65), surface sound speed (71) and
+        position (80) entries are read straight from the file for all
+        records at once.  For other types the array named in bulk_fields
+        (or the header) of each decoded record is collected.  A 'Time' field
+        with the datagram time is added to arrays that do not have one.
+        'fields' may be a list of field names to return.
+        """
+        if not self.mapped:
+            self.mapfile()
+        if not self.map.packdir.has_key(str(recordtype)):
+            print "record " + str(recordtype) + " not available."
+            return None
+        if int(recordtype) in (65, 71, 80):
+            data = self._get_all_fixed(int(recordtype))
+        elif int(recordtype) == 110:
+            data = self._get_all_110()
+        else:
+            data = self._get_all_decoded(int(recordtype))
+        if fields is not None:
+            if isinstance(fields, str):
+                fields = [fields]
+            data = self._copy_fields(data, [(name, data.dtype[name]) for name in fields])
+        return data
+        
+    def _get_all_fixed(self, recordtype, first = 0):
+        """
+        Reads the entries (or for position, the header) of every record of
+        the given type from record number 'first' on directly from the file
+        and converts them together.
+        """
+        packdir = self.map.packdir[str(recordtype)][first:]
+        locs = packdir[:,0].astype(np.int64)
+        times = packdir[:,1]
+        mm, buf = self._open_buffer()
+        start = locs + Datagram.hdr_dtype.itemsize
+        if recordtype == 80:
+            dtype = Data80.hdr_file_dtype[self.byteswap]
+            end = start + dtype.itemsize
+        else:
+            if recordtype == 65:
+                dtype = Data65.att_file_dtype[self.byteswap]
+                start += Data65.hdr_dtype.itemsize
+            else:
+                dtype = Data71.data_file_dtype[self.byteswap]
+                start += Data71.hdr_dtype.itemsize
+            # the length word counts the bytes following it, so the entries
+            # end at that many bytes on from the datagram start, just ahead of
+            # the trailing byte, the ETX and the checksum
+            end = locs + self._gather_uint(buf, locs, 4).astype(np.int64)
+        counts = (end - start) // dtype.itemsize
+        end = start + counts * dtype.itemsize
+        raw = np.concatenate([buf[a:b] for a,b in zip(start, end)] + [np.zeros(0, dtype = np.uint8)])
+        del buf
+        self._close_buffer(mm)
+        raw = np.frombuffer(raw, dtype = dtype)
+        if recordtype == 80:
+            return self._copy_fields(Data80.convert(raw), [('Time','d')] + Data80.hdr_dtype.descr,
+                times)
+        elif recordtype == 65:
+            return Data65.convert(raw, np.repeat(times, counts))
+        else:
+            return Data71.convert(raw, np.repeat(times, counts))
+            
+    def _get_all_110(self, first = 0):
+        """
+        Decodes the network attitude records from record number 'first' on.
+        The entry offsets of all records are found together by
+        Data110.find_offsets, and the entries are then read and converted
+        together.
+        """
+        packdir = self.map.packdir['110'][first:]
+        locs = packdir[:,0].astype(np.int64)
+        times = packdir[:,1]
+        mm, buf = self._open_buffer()
+        start = locs + Datagram.hdr_dtype.itemsize
+        # NumEntries follows the counter and serial number
+        counts = self._gather_uint(buf, start + 4, 2).astype(np.int64)
+        start += Data110.hdr_dtype.itemsize
+        offsets = Data110.find_offsets(buf, start, counts)
+        raw = Data110.gather(buf, offsets, self.byteswap)
+        del buf
+        self._close_buffer(mm)
+        return Data110.convert(raw, np.repeat(times, counts))
+        
+    def _get_all_decoded(self, recordtype):
+        """
+        Decodes each record of the given type and concatenates the array
+        named in bulk_fields, or the header, from each.
+        """
+        attr = allRead.bulk_fields.get(recordtype, 'header')
+        parts = []
+        times = []
+        for i in range(len(self.map.packdir[str(recordtype)])):
+            self.getrecord(recordtype, i)
+            part = np.asarray(getattr(self.packet.subpack, attr)).reshape(-1)
+            parts.append(part)
+            times.append(np.repeat(self.packet.time, len(part)))
+        data = np.concatenate(parts)
+        if 'Time' not in data.dtype.names:
+            data = self._copy_fields(data, [('Time','d')] + data.dtype.descr,
+                np.concatenate(times))
+        return data
+        
+    def _copy_fields(self, data, descr, times = None):
+        """
+        Copies the fields of 'data' named in the dtype description 'descr'
+        to a new array, filling the field 'Time' with 'times' if given.
+        """
+        out = np.zeros(len(data), dtype = descr)
+        for name in out.dtype.names:
+            if name == 'Time' and times is not None:
+                out[name] = times
+            else:
+                out[name] = data[name]
+        return out
+        
     def findpacket(self, recordtype, verbose = False):
         """
         Find the next record of the requested type.
@@ -165,42 +743,213 @@ class allRead:
                 self.read()
         self.get()
         
-    def getwatercolumn(self,recordnum):
+    def iter_records(self, types = None, decode = True, readahead = True,
+            blocksize = 4194304):
+        """
+        Yields a Datagram for each record in the file of the types in
+        'types', or of every type if 'types' is None, in file order.  The
+        records are decoded first if 'decode' is True.  Datagrams of other
+        types are stepped over by their length words without being made into
+        Datagram objects.  The file is read through its own handle, so the
+        file position and packet used by read, findpacket and getrecord are
+        left alone.  With 'readahead' the file is read in blocks of
+        'blocksize' bytes by a background thread that keeps the next block
+        ready while the current one is decoded.  Without it, the bodies of
+        unwanted datagrams are seeked over.  Memory mapped files are walked
+        in place.
+        """
+        if types is not None:
+            types = set([int(t) for t in np.atleast_1d(types)])
+        if self.use_mmap:
+            packets = self._walk_mmap(types)
+        elif readahead:
+            packets = self._walk_blocks(types, blocksize)
+        else:
+            packets = self._walk_seek(types)
+        for packet in packets:
+            if not packet.valid:
+                print "Record without proper STX or ETX found."
+            if decode:
+                packet.decode()
+            yield packet
+            
+    def _walk_mmap(self, types):
+        """
+        Yields the datagrams of the given types from the memory mapped file.
+        """
+        unpack = allRead.walk_struct[self.byteswap].unpack_from
+        minsize = Datagram.hdr_dtype.itemsize + 3
+        p = 0
+        while p + allRead.walk_struct[False].size <= self.filelen:
+            packetsize, stx, dtype = unpack(self.infile, p)
+            packetsize += 4
+            if packetsize < minsize or p + packetsize > self.filelen:
+                break
+            if types is None or dtype in types:
+                yield Datagram(self.mmbuf[p:p+packetsize], self.byteswap, self.lazy)
+            p += packetsize
+        if p < self.filelen:
+            print "Broken packet found at", p
+            
+    def _walk_seek(self, types):
+        """
+        Yields the datagrams of the given types, reading the start of each
+        datagram and seeking past the rest of those not wanted.
+        """
+        unpack = allRead.walk_struct[self.byteswap].unpack
+        start_sz = allRead.walk_struct[False].size
+        minsize = Datagram.hdr_dtype.itemsize + 3
+        infile = open(self.infilename, 'rb')
+        try:
+            p = 0
+            while p < self.filelen:
+                start = infile.read(start_sz)
+                if len(start) < start_sz:
+                    break
+                packetsize, stx, dtype = unpack(start)
+                packetsize += 4
+                if packetsize < minsize or p + packetsize > self.filelen:
+                    break
+                if types is None or dtype in types:
+                    yield Datagram(start + infile.read(packetsize - start_sz),
+                        self.byteswap, self.lazy)
+                else:
+                    infile.seek(packetsize - start_sz, 1)
+                p += packetsize
+            if p < self.filelen:
+                print "Broken packet found at", p
+        finally:
+            infile.close()
+            
+    def _walk_blocks(self, types, blocksize):
+        """
+        Yields the datagrams of the given types from blocks of the file read
+        ahead by a background thread.  'data' holds the unprocessed end of
+        the previous block followed by the current block, and 'skip' counts
+        the bytes of an unwanted datagram still to be passed over in the
+        blocks to come.
+        """
+        unpack = allRead.walk_struct[self.byteswap].unpack_from
+        start_sz = allRead.walk_struct[False].size
+        minsize = Datagram.hdr_dtype.itemsize + 3
+        infile = open(self.infilename, 'rb')
+        blocks = Queue.Queue(2)
+        stop = threading.Event()
+        reader = threading.Thread(target = _read_ahead,
+            args = (infile, blocksize, blocks, stop))
+        reader.daemon = True
+        reader.start()
+        data = ''
+        p = 0
+        # the file offset of data[0]
+        base = 0
+        skip = 0
+        broken = False
+        try:
+            while True:
+                while len(data) - p >= start_sz:
+                    packetsize, stx, dtype = unpack(data, p)
+                    packetsize += 4
+                    if packetsize < minsize:
+                        broken = True
+                        break
+                    if types is None or dtype in types:
+                        if len(data) - p < packetsize:
+                            break
+                        yield Datagram(data[p:p+packetsize], self.byteswap, self.lazy)
+                    elif len(data) - p < packetsize:
+                        skip = packetsize - (len(data) - p)
+                        skipfrom = base + p
+                        p = len(data)
+                        break
+                    p += packetsize
+                if broken:
+                    break
+                block = blocks.get()
+                if block == '':
+                    break
+                if skip > 0:
+                    n = min(skip, len(block))
+                    base += n
+                    block = block[n:]
+                    skip -= n
+                base += p
+                data = data[p:] + block
+                p = 0
+            if skip > 0:
+                print "Broken packet found at", skipfrom
+            elif broken or p < len(data):
+                print "Broken packet found at", base + p
+        finally:
+            stop.set()
+            while True:
+                try:
+                    blocks.get_nowait()
+                except Queue.Empty:
+                    break
+            reader.join()
+            infile.close()
+            
+    def getwatercolumn(self, recordnum, out = None):
         """
         This method is designed to get a watercolumn packet by the ping number
         where ping 0 is the first in the file.  Separate records are
         reassembled for the whole ping and stored as the current subpack class
-        as if it were a single record.
-        """
-        if not self.mapped:
-            self.mapfile()
-        timelist = list(set(self.map.packdir['107'][:,1]))
-        timelist.sort()
-        time = timelist[recordnum]
-        inx = np.nonzero(self.map.packdir['107'][:,1] == time)[0]
-        self.getrecord(107,inx[0])
+        as if it were a single record.  The records of each ping are found
+        from the ping table made when the file is mapped.  An int8 array may
+        be provided as 'out' to assemble the amplitudes into, so that paging
+        through pings does not allocate a new array for each; the amplitudes
+        are then a view of the corner of 'out' used.
+        """
+        parts = list(self.iter_watercolumn(recordnum))
+        # the last record may be held in the cache, so assemble into a copy
+        self.packet = copy.copy(self.packet)
+        self.packet.subpack = copy.copy(self.packet.subpack)
+        self.packet.subpack.header = self.packet.subpack.header.copy()
         numbeams = self.packet.subpack.header['Total#Beams']
-        totalsamples, subbeams = self.packet.subpack.ampdata.shape
+        totalsamples = max([ampdata.shape[0] for beam, rx, ampdata in parts])
+        if out is None:
+            ampdata = np.zeros((totalsamples, numbeams), dtype = 'b')
+        else:
+            ampdata = out[:totalsamples,:numbeams]
+            ampdata[:] = 0
         rx = np.zeros(numbeams, dtype = Data107.nrx_dtype)
-        ampdata = np.zeros((totalsamples, numbeams), dtype = 'b')
-        rx[:subbeams] = self.packet.subpack.rx
-        ampdata[:,:subbeams] = self.packet.subpack.ampdata
-        beamcount = subbeams
-        if len(inx) > 1:
-            for n in inx[1:]:
-                self.getrecord(107, n)
-                numsamples, subbeams = self.packet.subpack.ampdata.shape
-                if numsamples > totalsamples:
-                    temp = np.zeros((numsamples - totalsamples, numbeams), dtype = 'b')
-                    ampdata = np.append(ampdata, temp, axis = 0)
-                    totalsamples = numsamples
-                rx[beamcount:beamcount+subbeams] = self.packet.subpack.rx
-                ampdata[:numsamples,beamcount:beamcount+subbeams] = self.packet.subpack.ampdata
-                beamcount += subbeams
+        for beam, subrx, subamp in parts:
+            numsamples, subbeams = subamp.shape
+            rx[beam:beam+subbeams] = subrx
+            ampdata[:numsamples,beam:beam+subbeams] = subamp
         self.packet.subpack.rx = rx
         self.packet.subpack.ampdata = ampdata
         self.packet.subpack.header[2] = 1
         self.packet.subpack.header[3] = 1
+        
+    def iter_watercolumn(self, recordnum):
+        """
+        Yields the records of water column ping 'recordnum' one at a time as
+        the index of the first beam in the record, the rx array and the
+        (samples, beams) amplitude array, so that a ping can be worked
+        through without assembling it.  The record is also the current
+        packet while it is being used.
+        """
+        if not self.mapped:
+            self.mapfile()
+        first, count = self.map.getpings(107)[recordnum]
+        beamcount = 0
+        for n in range(first, first + count):
+            self.getrecord(107, n)
+            subpack = self.packet.subpack
+            yield beamcount, subpack.rx, subpack.ampdata
+            beamcount += len(subpack.rx)
+            
+    def getnumpings(self):
+        """
+        Returns the number of water column pings in the file.
+        """
+        if not self.mapped:
+            self.mapfile()
+        if not self.map.packdir.has_key('107'):
+            return 0
+        return len(self.map.getpings(107))
             
     def display(self):
         """
@@ -258,80 +1007,400 @@ class allRead:
                 pos = self.navarray[str(postype)]
                 att = self.navarray[str(att_type)]
                 # for time stamps in the time range, find that nav and att
-                for i in idx_range:
-                    ts = tstamps[i]
-                    prev = np.nonzero(pos[:,0] <= ts)[0][-1]
-                    navpts[i,:3] = self._interp_points(tstamps[i], pos[prev,:], pos[prev + 1,:])
-                    prev = np.nonzero(att[:,0] <= tstamps[i])[0][-1]
-                    navpts[i,3:] = self._interp_points(tstamps[i], att[prev,:], att[prev + 1,:])[1:]
+                ts = tstamps[idx_range]
+                navpts[idx_range,:3] = self._interp_array(ts, pos)
+                # heading is the last attitude column
+                navpts[idx_range,3:] = self._interp_array(ts, att, wrap = [4])[:,1:]
             # convert roll(3), pitch(4) and heading(6) into radians 
             if not degrees:
                 navpts[:,[3,4,6]] = np.deg2rad(navpts[:,[3,4,6]])
             return navpts
                 
-    def _interp_points(self, tstamp, pt1, pt2):
-        """
-        Performs an interpolation for the points given and returns the
-        interpolated points.  The first field of each point array is assumed to
-        be the time stamp, and all other values in the array are interpolated.
-        """
-        delta = pt2 - pt1
-        result = pt1 + (tstamp - pt1[0]) * delta / delta[0]
+    def _interp_array(self, tstamps, points, wrap = []):
+        """
+        Interpolates the rows of the 'points' array, which are ordered by the
+        time stamp in the first column, at each of the given time stamps.
+        Each time stamp is interpolated between the last row at or before it
+        and the following row, found by a binary search.  The columns listed
+        in 'wrap' are angles in degrees that are interpolated across the
+        0/360 boundary and returned in the range 0 to 360.
+        """
+        prev = np.searchsorted(points[:,0], tstamps, side = 'right') - 1
+        prev = np.clip(prev, 0, len(points) - 2)
+        pt1 = points[prev,:]
+        delta = points[prev + 1,:] - pt1
+        for col in wrap:
+            delta[:,col] = (delta[:,col] + 180) % 360 - 180
+        result = pt1 + (tstamps - pt1[:,0])[:,np.newaxis] * delta / delta[:,[0]]
+        for col in wrap:
+            result[:,col] %= 360
         return result
-            
-    def build_navarray(self):
+        
+    def build_navarray(self, save = True):
         """
         The objective is to do the work of building an array of the navigation
         data to speed up processing later.  It is stored in a dictionary of
         arrays for each navigation datagram.  Position information is in arrays
         ordered as time, latitude, longitude.  Attitude information is in
-        arrays ordered as time, roll, pitch, heave, heading.
+        arrays ordered as time, roll, pitch, heave, heading.  If the file map
+        was loaded from or saved to an index file, the arrays are saved with
+        it, if it can be written and 'save' is True, and are used from there
+        the next time the file is opened.
         """
         self.navarray = {}
         if not self.mapped:
             self.mapfile()
+        navtypes = [key for key in ['80', '65', '110'] if self.map.packdir.has_key(key)]
+        if all([self.map.aux.has_key('nav' + key) for key in navtypes]):
+            # saved with the file map, copied out of the memory mapped index
+            # so that saving the map again does not change them
+            for key in navtypes:
+                self.navarray[key] = np.array(self.map.aux['nav' + key])
+            return
         if self.map.packdir.has_key('80'):
             print 'creating position array'
-            numpos = len(self.map.packdir['80'])
-            self.navarray['80'] = np.zeros((numpos,3))
-            for i in range(numpos):
-                self.getrecord(80, i)
-                self.navarray['80'][i,0] = self.packet.time
-                self.navarray['80'][i,1] = self.packet.subpack.header[2]
-                self.navarray['80'][i,2] = self.packet.subpack.header[3]
+            self.navarray['80'] = self._build_nav('80')
         if self.map.packdir.has_key('65'):
             print 'creating attitude array (65)'
-            time = []
-            roll = []
-            pitch = []
-            heave = []
-            heading = []
-            numatt = len(self.map.packdir['65'])
-            for i in range(numatt):
-                self.getrecord(65, i)
-                time += list(self.packet.subpack.data['Time'])
-                roll += list(self.packet.subpack.data['Roll'])
-                pitch += list(self.packet.subpack.data['Pitch'])
-                heave += list(self.packet.subpack.data['Heave'])
-                heading += list(self.packet.subpack.data['Heading'])
-            self.navarray['65'] = np.asarray(zip(time,roll,pitch,heave,heading))
+            self.navarray['65'] = self._build_nav('65')
         if self.map.packdir.has_key('110'):
             print 'creating attitude array (110)'
-            time = []
-            roll = []
-            pitch = []
-            heave = []
-            heading = []
-            numatt = len(self.map.packdir['110'])
-            for i in range(numatt):
-                self.getrecord(110, i)
-                time += list(self.packet.subpack.data['Time'])
-                roll += list(self.packet.subpack.data['Roll'])
-                pitch += list(self.packet.subpack.data['Pitch'])
-                heave += list(self.packet.subpack.data['Heave'])
-                heading += list(self.packet.subpack.data['Heading'])
-            self.navarray['110'] = np.asarray(zip(time,roll,pitch,heave,heading))
+            self.navarray['110'] = self._build_nav('110')
+        if save and self.mapfilename != '':
+            self._save_map(self.mapfilename)
+            
+    def build_geoindex(self, recordtype, postype = 80, save = False):
+        """
+        Makes the position index of the records of the given type for
+        mappack.getrecords_in_box.  The position of each record is
+        interpolated at its time stamp from the position array of the
+        navigation array, so no records of the type are decoded.  Records
+        outside the times of the position records are left out.  The
+        positions are binned in a grid of square cells, with about the
+        square root of the number of records cells along the longer side,
+        and are stored sorted by cell in the map 'aux' dictionary, so the
+        index is kept when the file map is saved.  With 'save' the map is
+        saved here as well, if the index file can be written.
+        """
+        if not self.mapped:
+            self.mapfile()
+        if not self.__dict__.has_key('navarray'):
+            self.build_navarray(save = False)
+        key = str(int(recordtype))
+        times = self.map.gettimes(recordtype)
+        latlon = np.empty((len(times), 2))
+        latlon[:] = np.nan
+        if self.navarray.has_key(str(postype)) and len(self.navarray[str(postype)]) > 1:
+            pos = self.navarray[str(postype)]
+            inside = (times >= pos[0,0]) & (times <= pos[-1,0])
+            latlon[inside] = self._interp_array(times[inside], pos)[:,1:]
+        records = np.nonzero(~np.isnan(latlon).any(axis = 1))[0]
+        latlon = latlon[records]
+        if len(records) > 0:
+            origin = latlon.min(axis = 0)
+            span = latlon.max(axis = 0) - origin
+        else:
+            origin = span = np.zeros(2)
+        cellsize = span.max() / max(1, int(np.sqrt(len(records))))
+        if cellsize == 0:
+            cellsize = 1.
+        numrows, numcols = (span / cellsize).astype(np.int64) + 1
+        cells = np.floor((latlon - origin) / cellsize)
+        cellnum = cells[:,0] * numcols + cells[:,1]
+        order = np.lexsort((records, cellnum))
+        self.map.aux['geo' + key] = np.column_stack((cellnum, latlon,
+            records))[order].reshape(-1, 4)
+        self.map.aux['geogrid' + key] = np.array([origin[0], origin[1], cellsize,
+            numrows, numcols])
+        if save:
+            self._save_map(self.mapfilename)
+            
+    def _build_nav(self, recordtype, start = 0):
+        """
+        Builds the navigation array for the records of the given type from
+        record number 'start' through the end of the map.  The records are
+        decoded in bulk and copied into an array allocated once.
+        """
+        recordtype = str(recordtype)
+        if recordtype == '80':
+            data = self._get_all_fixed(80, start)
+            fields = ['Time', 'Latitude', 'Longitude']
+        else:
+            if recordtype == '65':
+                data = self._get_all_fixed(65, start)
+            else:
+                data = self._get_all_110(start)
+            fields = ['Time', 'Roll', 'Pitch', 'Heave', 'Heading']
+        navarray = np.empty((len(data), len(fields)))
+        for n, name in enumerate(fields):
+            navarray[:,n] = data[name]
+        return navarray
+            
+def _map_range(args):
+    """
+    Process pool worker for allRead.mapfile.  Maps the datagrams beginning
+    in the byte range (start, stop) of the file, starting from the first
+    valid datagram found in the range.  Returns the offset of that first
+    datagram, the offset following the last datagram mapped, and the
+    locations, types, times and validity of the datagrams.
+    """
+    infilename, byteswap, start, stop = args
+    reader = allRead(infilename, byteswap = byteswap, use_mmap = True)
+    first = reader._resync(start, stop)
+    locs, end = reader._scan(reader.infile, first, stop)
+    types, times, valid = reader._scan_headers(reader.mmbuf, locs, end)
+    reader.close()
+    return first, end, locs, types, times, valid
+    
+    
+# the resolver and output arrays of a resolve_all_pings pool process
+_resolve_state = {}
+    
+def _resolve_init(settings):
+    """
+    Process pool initializer for resolve_file_depths.resolve_all_pings.
+    Opens the file with its saved map and navigation and the output arrays
+    once for each process.
+    """
+    resolver = resolve_file_depths(settings['filename'])
+    resolver.set_patch_test_values(*settings['patchtest'])
+    resolver.ssp_filename = settings['ssp_filename']
+    resolver.have_ssp_file = settings['have_ssp_file']
+    resolver.apply_heading = settings['apply_heading']
+    resolver.apply_xducer_depth = settings['apply_xducer_depth']
+    _resolve_state['resolver'] = resolver
+    _resolve_state['outputs'] = [np.load(name, mmap_mode = 'r+')
+        for name in settings['outnames']]
+    
+    
+def _resolve_block(block):
+    """
+    Process pool worker for resolve_file_depths.resolve_all_pings.  Resolves
+    the pings in the range 'block' into the output arrays and returns the
+    number of pings resolved.
+    """
+    first, last = block
+    count = _resolve_state['resolver']._write_block(first, last, _resolve_state['outputs'])
+    for out in _resolve_state['outputs']:
+        out.flush()
+    return count
+    
+    
+def _read_ahead(infile, blocksize, blocks, stop):
+    """
+    Thread target for allRead.iter_records.  Reads 'infile' in blocks of
+    'blocksize' bytes into the queue 'blocks', ending with an empty string at
+    the end of the file, until the threading.Event 'stop' is set.  After
+    setting 'stop' the consumer must empty the queue so a waiting put can
+    finish.
+    """
+    while True:
+        block = infile.read(blocksize)
+        blocks.put(block)
+        if block == '' or stop.is_set():
+            break
+            
+            
+def _pad_ragged(samples, offsets, scale):
+    """
+    Spreads a flat array of samples, where the samples of row n run from
+    offsets[n] to offsets[n+1], into a float array with a row per entry,
+    padded with zeros to the longest row, and applies the scale factor.
+    """
+    numsamples = np.diff(offsets)
+    numrows = len(numsamples)
+    maxsamples = numsamples.max() if numrows > 0 else 0
+    dense = np.zeros((numrows, maxsamples), dtype = 'float')
+    rows = np.repeat(np.arange(numrows), numsamples)
+    cols = np.arange(len(samples)) - np.repeat(offsets[:-1], numsamples)
+    dense[rows, cols] = samples
+    dense *= scale
+    return dense
+    
+    
+def _byteorders(dtype):
+    """
+    Returns the dtype in little endian and in big endian byte order in a
+    dict keyed by the byteswap flag, so the decoders can choose the dtype for
+    the byte order of the file once rather than swapping each record.
+    """
+    dtype = np.dtype(dtype)
+    return {False:dtype.newbyteorder('<'), True:dtype.newbyteorder('>')}
+    
+    
+class scaledarray:
+    """
+    A structured array held as the raw values found in the file, for
+    decoding only the fields that are used.  Indexing with a field name
+    converts that field to its type in 'dtype', multiplies it by its factor
+    in 'scale' and adds its value in 'offset', and keeps the result.  Any
+    other index, or an attribute of the full array such as 'shape', converts
+    all fields into a 'dtype' array first.  toarray returns that array.
+    """
+    
+    def __init__(self, raw, dtype, scale = {}, offset = {}):
+        """
+        'raw' is the array as found in the file, and must have a field of
+        the same name for each field in 'dtype'.
+        """
+        self.raw = raw
+        self.dtype = dtype
+        self.scale = scale
+        self.offset = offset
+        self._fields = {}
+        self._array = None
+        
+    def __len__(self):
+        return len(self.raw)
+        
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.field(key)
+        return self.toarray()[key]
+        
+    def __setitem__(self, key, value):
+        self.toarray()[key] = value
+        
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.toarray(), name)
+        
+    def __array__(self, dtype = None):
+        if dtype is None:
+            return self.toarray()
+        return self.toarray().astype(dtype)
+        
+    def field(self, name):
+        """
+        Returns the named field converted and scaled.
+        """
+        if self._array is not None:
+            return self._array[name]
+        if not self._fields.has_key(name):
+            values = self.raw[name].astype(self.dtype[name])
+            if self.scale.has_key(name):
+                values *= self.scale[name]
+            if self.offset.has_key(name):
+                values += self.offset[name]
+            self._fields[name] = values
+        return self._fields[name]
+        
+    def toarray(self):
+        """
+        Returns all fields converted and scaled in a single array.
+        """
+        if self._array is None:
+            if not self._fields and len(self.raw.dtype.names) == len(self.dtype.names):
+                # the fields line up, so convert them all in one pass
+                array = self.raw.astype(self.dtype)
+                for name in self.dtype.names:
+                    if self.scale.has_key(name):
+                        array[name] *= self.scale[name]
+                    if self.offset.has_key(name):
+                        array[name] += self.offset[name]
+            else:
+                array = np.zeros(len(self.raw), dtype = self.dtype)
+                for name in self.dtype.names:
+                    array[name] = self.field(name)
+            self._array = array
+            self._fields = {}
+        return self._array
+        
+        
+class recordcache:
+    """
+    A least recently used store of decoded datagrams keyed by record type
+    and record number, holding up to about 'maxsize' bytes.  The size of a
+    datagram is taken as the size of its data block plus the arrays and
+    strings of its decoded subpack.  Other objects may be stored with a
+    size given in any unit that maxsize is counted in.  'hits', 'misses'
+    and 'evictions' count the lookups found, the lookups not found and the
+    objects dropped.
+    """
+    
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._records = OrderedDict()
+        
+    def __len__(self):
+        return len(self._records)
+        
+    def get(self, key):
+        """
+        Returns the datagram stored under key, marking it as the most
+        recently used, or None if it is not stored.
+        """
+        if not self._records.has_key(key):
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry = self._records.pop(key)
+        self._records[key] = entry
+        return entry[0]
+        
+    def put(self, key, packet, nbytes = None):
+        """
+        Stores the datagram under key and drops the least recently used
+        datagrams until the store fits in maxsize.  A datagram larger than
+        maxsize is not stored.  'nbytes' is the size of the datagram, or of
+        another object, if it is not to be found by sizeof.
+        """
+        if self._records.has_key(key):
+            self.size -= self._records.pop(key)[1]
+        if nbytes is None:
+            nbytes = recordcache.sizeof(packet)
+        if nbytes > self.maxsize:
+            return
+        self._records[key] = (packet, nbytes)
+        self.size += nbytes
+        while self.size > self.maxsize:
+            oldkey, (oldpacket, oldbytes) = self._records.popitem(last = False)
+            self.size -= oldbytes
+            self.evictions += 1
             
+    def clear(self):
+        """
+        Drops all stored datagrams.  The counters are kept.
+        """
+        self._records.clear()
+        self.size = 0
+        
+    @staticmethod
+    def sizeof(packet):
+        """
+        Returns the approximate size in bytes of a decoded datagram.
+        """
+        nbytes = len(packet.datablock)
+        if packet.__dict__.has_key('subpack'):
+            for value in packet.subpack.__dict__.values():
+                if isinstance(value, scaledarray):
+                    nbytes += 2 * value.raw.nbytes
+                elif isinstance(value, (np.ndarray, np.generic)):
+                    nbytes += value.nbytes
+                elif isinstance(value, str):
+                    nbytes += len(value)
+                elif isinstance(value, dict):
+                    nbytes += sum([len(str(k)) + len(str(v)) for k, v in value.items()])
+        return nbytes
+        
+    def display(self):
+        """
+        Prints the size and counters of the cache.
+        """
+        print str(len(self._records)) + ' records, size ' + str(self.size) + ' of ' + \
+            str(self.maxsize)
+        print 'hits : ' + str(self.hits)
+        print 'misses : ' + str(self.misses)
+        print 'evictions : ' + str(self.evictions)
+        if self.hits + self.misses > 0:
+            print 'hit rate : ' + '%.3f' % (float(self.hits) / (self.hits + self.misses))
+        
+        
 class Datagram:
     """
     The datagram holder.  Reads the header section of the provided memory
@@ -346,34 +1415,35 @@ class Datagram:
     checksum field.
     Note: While not required of these datagrams, the size of the datagram, as
     if coming from a file, is expected at the beginning of these datablocks.
+    The memory block may be a string or a uint8 array view, such as a slice
+    of a memory mapped file, in which case 'datablock' is also a view.
     """
     
     hdr_dtype = np.dtype([('Bytes','I'),('Start','B'),('Type','B'),
         ('Model','H'),('Date','I'),('Time','I')])
+    # the header and the ETX and checksum at the end, in each byte order
+    hdr_struct = {False:struct.Struct('<IBBHII'), True:struct.Struct('>IBBHII')}
+    tail_struct = {False:struct.Struct('<BH'), True:struct.Struct('>BH')}
+    # decoders by datagram type, see register_decoder
+    decoders = {}
+    # days from 1970-01-01 by datagram date, see maketime
+    epoch_days = {}
     
-    def __init__(self, fileblock, byteswap = False):
+    def __init__(self, fileblock, byteswap = False, lazy = False):
         """Reads the header section, which is the first 16 bytes, of the
-        given memory block."""
+        given memory block.  'lazy' is passed to the decoders that return
+        scaledarray objects."""
         self.byteswap = byteswap
+        self.lazy = lazy
         hdr_sz = Datagram.hdr_dtype.itemsize
-        self.header = np.frombuffer(fileblock[:hdr_sz], dtype = Datagram.hdr_dtype)
-        if byteswap:
-            self.header = self.header.byteswap()
-        self.header = self.header[0]
+        header = Datagram.hdr_struct[byteswap].unpack_from(fileblock)
+        self.header = np.array(header, dtype = Datagram.hdr_dtype)[()]
         self.decoded = False
-        if self.header[1] == 2:
-            self.valid = True
-        else:
-            self.valid = False
         self.datablock = fileblock[hdr_sz:-3]
-        etx = np.frombuffer(fileblock[-3:-2], dtype=np.uint8, count=1)[0]
-        if etx != 3:
-            self.valid = False
-        if byteswap:
-            self.checksum = np.frombuffer(fileblock[-2:], dtype=np.uint16, count=1)[0].newbyteorder()
-        else:
-            self.checksum = np.frombuffer(fileblock[-2:], dtype=np.uint16, count=1)[0]
-        self.dtype = self.header[2]
+        etx, self.checksum = Datagram.tail_struct[byteswap].unpack_from(fileblock,
+            len(fileblock) - 3)
+        self.valid = header[1] == 2 and etx == 3
+        self.dtype = header[2]
         try:
             self.maketime()
         except ValueError:
@@ -381,47 +1451,11 @@ class Datagram:
         
     def decode(self):
         """
-        Directs to the correct decoder.
-        """
-        if self.dtype == 49:
-            self.subpack = Data49(self.datablock, self.byteswap)
-        elif self.dtype == 65:
-            self.subpack = Data65(self.datablock, self.time, self.byteswap)
-        elif self.dtype == 67:
-            self.subpack = Data67(self.datablock, self.byteswap)
-        elif self.dtype == 68:
-            self.subpack = Data68(self.datablock, self.byteswap)
-        elif self.dtype == 71:
-            self.subpack = Data71(self.datablock, self.time, self.byteswap)
-        elif self.dtype == 73:
-            self.subpack = Data73(self.datablock, self.byteswap)
-        elif self.dtype == 78:
-            self.subpack = Data78(self.datablock, self.byteswap)
-        elif self.dtype == 79:
-            self.subpack = Data79(self.datablock, self.byteswap)
-        elif self.dtype == 80:
-            self.subpack = Data80(self.datablock, self.byteswap)
-        elif self.dtype == 82:
-            self.subpack = Data82(self.datablock, self.byteswap)
-        elif self.dtype == 83:
-            self.subpack = Data83(self.datablock, self.byteswap)
-        elif self.dtype == 85:
-            self.subpack = Data85(self.datablock, self.byteswap)
-        elif self.dtype == 88:
-            self.subpack = Data88(self.datablock, self.byteswap)
-        elif self.dtype == 89:
-            self.subpack = Data89(self.datablock, self.byteswap)
-        elif self.dtype == 102:
-            self.subpack = Data102(self.datablock, self.byteswap)
-        elif self.dtype == 105:
-            #same definition for this data type
-            self.subpack = Data73(self.datablock, self.byteswap)
-        elif self.dtype == 107:
-            self.subpack = Data107(self.datablock, self.byteswap)
-        elif self.dtype == 109:
-            self.subpack = Data109(self.datablock, self.byteswap)
-        elif self.dtype == 110:
-            self.subpack = Data110(self.datablock, self.time, self.byteswap)
+        Directs to the decoder registered for the datagram type.
+        """
+        if Datagram.decoders.has_key(self.dtype):
+            decoder, args = Datagram.decoders[self.dtype]
+            self.subpack = decoder(self.datablock, *[getattr(self, arg) for arg in args])
         else:
             print "Data record " + str(self.dtype) + " decoding is not yet supported."
         self.decoded = True
@@ -431,12 +1465,17 @@ class Datagram:
         Makes the time stamp of the current packet as a POSIX time stamp.
         UTC is assumed.
         """
-        date = str(self.header[-2])
-        year = int(date[:4])
-        month = int(date[4:6])
-        day = int(date[6:])
-        numdays = dtm.date(year, month, day).toordinal() - dtm.date(1970,1,1).toordinal()
-        dayseconds = self.header[-1] * 0.001
+        date = int(self.header[-2])
+        if Datagram.epoch_days.has_key(date):
+            numdays = Datagram.epoch_days[date]
+        else:
+            date = str(date)
+            year = int(date[:4])
+            month = int(date[4:6])
+            day = int(date[6:])
+            numdays = dtm.date(year, month, day).toordinal() - dtm.date(1970,1,1).toordinal()
+            Datagram.epoch_days[int(date)] = numdays
+        dayseconds = int(self.header[-1]) * 0.001
         self.time = numdays * 24 * 60 * 60 + dayseconds
         
     def gettime(self):
@@ -476,27 +1515,27 @@ class Data49:
         ('TransducerSoundSpeedFromProfile',"f"),('YawStabAngle',"f"),
         ('PortCoverageORAbeamVelocity','h'),
         ('StarboardCoverageORDownVelocity','h'),('EM2040CPUTemp','b')])
+    hdr_file_dtype = _byteorders([('StatusDatagramCount','H'),('SystemSerialNum','H'),
+        ('PingRate',"H"),('PingCounter','H'),('SwathDistance','B'),
+        ('SensorInputStatusUDP2','I'),('SensorInputStatusSerial1','I'),
+        ('SensorInputStatusSerial2','I'),('SensorInputStatusSerial3','I'),
+        ('SensorInputStatusSerial4','I'),('PPSstatus','b'),
+        ('PositionStatus','b'),('AttitudeStatus','b'),('ClockStatus','b'),
+        ('HeadingStatus','b'),('PUstatus','B'),('LastHeading',"H"),
+        ('LastRoll',"h"),('LastPitch',"h"),('LastSonarHeave',"h"),
+        ('TransducerSoundSpeed',"H"),('LastDepth',"I"),('ShipVelocity',"h"),
+        ('AttitudeVelocityStatus','B'),('MammalProtectionRamp','B'),
+        ('BackscatterOblique','b'),('BackscatterNormal','b'),('FixedGain','b'),
+        ('DepthNormalIncidence','B'),('RangeNormalIncidence','H'),
+        ('PortCoverage','B'),('StarboardCoverage','B'),
+        ('TransducerSoundSpeedFromProfile',"H"),('YawStabAngle',"h"),
+        ('PortCoverageORAbeamVelocity','h'),
+        ('StarboardCoverageORDownVelocity','h'),('EM2040CPUTemp','b')])
         
     def __init__(self, datablock, byteswap = False):
         """Catches the binary datablock and decodes the first section and calls
         the decoder for the rest of the record."""
-        
-        hdr_dtype = np.dtype([('StatusDatagramCount','H'),('SystemSerialNum','H'),
-            ('PingRate',"H"),('PingCounter','H'),('SwathDistance','B'),
-            ('SensorInputStatusUDP2','I'),('SensorInputStatusSerial1','I'),
-            ('SensorInputStatusSerial2','I'),('SensorInputStatusSerial3','I'),
-            ('SensorInputStatusSerial4','I'),('PPSstatus','b'),
-            ('PositionStatus','b'),('AttitudeStatus','b'),('ClockStatus','b'),
-            ('HeadingStatus','b'),('PUstatus','B'),('LastHeading',"H"),
-            ('LastRoll',"h"),('LastPitch',"h"),('LastSonarHeave',"h"),
-            ('TransducerSoundSpeed',"H"),('LastDepth',"I"),('ShipVelocity',"h"),
-            ('AttitudeVelocityStatus','B'),('MammalProtectionRamp','B'),
-            ('BackscatterOblique','b'),('BackscatterNormal','b'),('FixedGain','b'),
-            ('DepthNormalIncidence','B'),('RangeNormalIncidence','H'),
-            ('PortCoverage','B'),('StarboardCoverage','B'),
-            ('TransducerSoundSpeedFromProfile',"H"),('YawStabAngle',"h"),
-            ('PortCoverageORAbeamVelocity','h'),
-            ('StarboardCoverageORDownVelocity','h'),('EM2040CPUTemp','b')])
+        hdr_dtype = Data49.hdr_file_dtype[byteswap]
         hdr_sz = hdr_dtype.itemsize
         self.header = np.frombuffer(datablock[:hdr_sz], dtype=hdr_dtype)[0]
         print '*Warning: This datagram is not currently decoded correctly!*'
@@ -531,15 +1570,23 @@ class Data65:
     """
     
     hdr_dtype = np.dtype([('Counter','H'),('Seriel#','H'),('NumEntries','H')])
+    hdr_file_dtype = _byteorders(hdr_dtype)
     att_dtype = np.dtype([('Time','d'),('Status','H'),('Roll','f'),('Pitch','f'),
         ('Heave','f'),('Heading','f')])
+    att_file_dtype = _byteorders([('Time','H'),('Status','H'),('Roll','h'),('Pitch','h'),
+        ('Heave','h'),('Heading','H')])
+    att_scale = {'Time':0.001, 'Roll':0.01, 'Pitch':0.01, 'Heave':0.01,
+        'Heading':0.01}
         
-    def __init__(self, datablock, POSIXtime, byteswap = False):
+    def __init__(self, datablock, POSIXtime, byteswap = False, lazy = False):
         """Catches the binary datablock and decodes the first section and calls
-        the decoder for the rest of the record."""
+        the decoder for the rest of the record.  With 'lazy' the 'data'
+        array is a scaledarray."""
         self.time = POSIXtime
+        self.byteswap = byteswap
+        self.lazy = lazy
         hdr_sz = Data65.hdr_dtype.itemsize
-        self.header = np.frombuffer(datablock[:hdr_sz], dtype=Data65.hdr_dtype)[0]
+        self.header = np.frombuffer(datablock[:hdr_sz], dtype=Data65.hdr_file_dtype[byteswap])[0]
         self.sensor_descriptor = np.frombuffer(datablock[-1:], dtype=np.uint8)[0]
         self.read(datablock[hdr_sz:])
         
@@ -548,15 +1595,21 @@ class Data65:
         Reads the data section of the record.  Time is in POSIX time,
         angles are in degrees, distances in meters.
         """
-        att_file_dtype = np.dtype([('Time','H'),('Status','H'),('Roll','h'),('Pitch','h'),
-            ('Heave','h'),('Heading','H')])
-        self.data = np.frombuffer(datablock[:-1], dtype=att_file_dtype)
-        self.data = self.data.astype(Data65.att_dtype)
-        self.data['Time'] = self.data['Time'] * 0.001 + self.time
-        self.data['Roll'] *= 0.01
-        self.data['Pitch'] *= 0.01
-        self.data['Heave'] *= 0.01
-        self.data['Heading'] *= 0.01
+        self.data = np.frombuffer(datablock[:-1], dtype=Data65.att_file_dtype[self.byteswap])
+        self.data = Data65.convert(self.data, self.time, self.lazy)
+        
+    @staticmethod
+    def convert(data, POSIXtime, lazy = False):
+        """
+        Converts an array of entries as found in the file to the att_dtype
+        array, or with 'lazy' a scaledarray.  POSIXtime is the datagram
+        time, or an array of the datagram time for each entry.
+        """
+        data = scaledarray(data, Data65.att_dtype, Data65.att_scale,
+            {'Time':POSIXtime})
+        if lazy:
+            return data
+        return data.toarray()
         
     def display(self):
         """
@@ -574,6 +1627,8 @@ class Data67:
     """
     hdr_dtype = np.dtype([('ClockCounter','H'),('SystemSerial#','H'),
         ('Date','I'),('Time','I'),('1PPS','B')])
+    hdr_file_dtype = _byteorders(hdr_dtype)
+    
     def __init__(self,datablock, byteswap = False):
         """
         Catches the binary datablock and decodes the first section and calls
@@ -581,7 +1636,7 @@ class Data67:
         """
         hdr_sz = Data67.hdr_dtype.itemsize
         self.header = np.frombuffer(datablock[:hdr_sz], 
-            dtype = Data67.hdr_dtype)[0]
+            dtype = Data67.hdr_file_dtype[byteswap])[0]
         if len(datablock) > hdr_sz:
             print len(datablock), hdr_sz
             
@@ -608,16 +1663,22 @@ class Data68:
         ('BeamDepressionAngle',"f"),('BeamAzimuthAngle',"f"),
         ('OneWayRange',"f"),('QualityFactor','B'),
         ('DetectionWindowLength',"f"),('Reflectivity',"f"),('BeamNumber','B')])
+    hdr_file_dtype = _byteorders([('PingCounter','H'),('SystemSerial#','H'),
+        ('VesselHeading',"H"),('SoundSpeed',"H"),('TransducerDepth',"H"),
+        ('MaximumBeams','B'),('ValidBeams','B'),('Zresolution',"B"),
+        ('XYresolution',"B"),('SampleRate','H')])
+    xyz_file_dtype = _byteorders([('Depth',"h"),('AcrossTrack',"h"),('AlongTrack',"h"),
+        ('BeamDepressionAngle',"h"),('BeamAzimuthAngle',"H"),
+        ('OneWayRange',"H"),('QualityFactor','B'),
+        ('DetectionWindowLength',"B"),('Reflectivity',"b"),('BeamNumber','B')])
         
     def __init__(self,datablock, byteswap = False):
         """
         Catches the binary datablock and decodes the first section and calls
         the decoder for the rest of the record.
         """
-        hdr_dtype = np.dtype([('PingCounter','H'),('SystemSerial#','H'),
-            ('VesselHeading',"H"),('SoundSpeed',"H"),('TransducerDepth',"H"),
-            ('MaximumBeams','B'),('ValidBeams','B'),('Zresolution',"B"),
-            ('XYresolution',"B"),('SampleRate','H')])
+        self.byteswap = byteswap
+        hdr_dtype = Data68.hdr_file_dtype[byteswap]
         hdr_sz = hdr_dtype.itemsize
         self.header = np.frombuffer(datablock[:hdr_sz], dtype = hdr_dtype)[0]
         self.header = self.header.astype(Data68.hdr_dtype)
@@ -636,11 +1697,7 @@ class Data68:
         Decodes the repeating data section, and shifts all values into meters,
         degrees, or whole units.
         """
-        xyz_dtype = np.dtype([('Depth',"h"),('AcrossTrack',"h"),('AlongTrack',"h"),
-            ('BeamDepressionAngle',"h"),('BeamAzimuthAngle',"H"),
-            ('OneWayRange',"H"),('QualityFactor','B'),
-            ('DetectionWindowLength',"B"),('Reflectivity',"b"),('BeamNumber','B')])       
-        self.data = np.frombuffer(datablock, dtype = xyz_dtype)
+        self.data = np.frombuffer(datablock, dtype = Data68.xyz_file_dtype[self.byteswap])
         self.data = self.data.astype(Data68.xyz_dtype)
         self.data['Depth'] *= self.header['Zresolution']
         self.data['AcrossTrack'] *= self.header['XYresolution']
@@ -667,22 +1724,35 @@ class Data71:
     """
     hdr_dtype = np.dtype([('SoundSpeedCounter','H'),('SystemSerial#','H'),
         ('NumEntries','H')])
+    hdr_file_dtype = _byteorders(hdr_dtype)
     data_dtype = np.dtype([('Time','d'),('SoundSpeed','f')])
+    data_file_dtype = _byteorders([('Time','H'),('SoundSpeed','H')])
+    data_scale = {'SoundSpeed':0.1}
     
-    def __init__(self, datablock, POSIXtime, byteswap = False):
+    def __init__(self, datablock, POSIXtime, byteswap = False, lazy = False):
         """
         Catches the binary datablock and decodes the first section and calls
-        the decoder for the rest of the record.
+        the decoder for the rest of the record.  With 'lazy' the 'data'
+        array is a scaledarray.
         """
-        data_dtype = np.dtype([('Time','H'),('SoundSpeed','H')])
         hdr_sz = Data71.hdr_dtype.itemsize
-        data_sz = data_dtype.itemsize
         self.header = np.frombuffer(datablock[:hdr_sz], 
-            dtype = Data71.hdr_dtype)[0]
-        self.data = np.frombuffer(datablock[hdr_sz:-1], dtype = data_dtype)
-        self.data = self.data.astype(Data71.data_dtype)
-        self.data['Time'] += POSIXtime
-        self.data['SoundSpeed'] *= 0.1
+            dtype = Data71.hdr_file_dtype[byteswap])[0]
+        self.data = np.frombuffer(datablock[hdr_sz:-1], dtype = Data71.data_file_dtype[byteswap])
+        self.data = Data71.convert(self.data, POSIXtime, lazy)
+        
+    @staticmethod
+    def convert(data, POSIXtime, lazy = False):
+        """
+        Converts an array of entries as found in the file to the data_dtype
+        array, or with 'lazy' a scaledarray.  POSIXtime is the datagram
+        time, or an array of the datagram time for each entry.
+        """
+        data = scaledarray(data, Data71.data_dtype, Data71.data_scale,
+            {'Time':POSIXtime})
+        if lazy:
+            return data
+        return data.toarray()
             
     def display(self):
         """
@@ -699,6 +1769,7 @@ class Data73:
     remainder of the record is ascii, comma delimited.
     """
     hdr_dtype = np.dtype([('SurveyLine#','H'),('Serial#','H'),('Serial#2','H')])
+    hdr_file_dtype = _byteorders(hdr_dtype)
     
     def __init__(self, datablock, byteswap = False):
         """
@@ -707,8 +1778,12 @@ class Data73:
         """
         hdr_sz = Data73.hdr_dtype.itemsize
         self.header = np.frombuffer(datablock[:hdr_sz],
-            dtype = Data73.hdr_dtype)[0]
-        temp = datablock[hdr_sz:].split(',')
+            dtype = Data73.hdr_file_dtype[byteswap])[0]
+        text = datablock[hdr_sz:]
+        if not isinstance(text, str):
+            # memory mapped datagrams arrive as uint8 arrays
+            text = text.tostring()
+        temp = text.split(',')
         self.settings = {}
         for entry in temp:
             data = entry.split('=')
@@ -743,12 +1818,26 @@ class Data78:
     nrx_dtype = np.dtype([('BeamPointingAngle','f'),('TransmitSectorID','B'),('DetectionInfo','B'),
         ('WindowLength','H'),('QualityFactor','B'),('Dcorr','b'),('TravelTime','f'),
         ('Reflectivity','f'),('CleaningInfo','b'),('Spare','B')])
+    hdr_file_dtype = _byteorders([('Counter','H'),('Serial#','H'),('SoundSpeed','H'),
+        ('Ntx','H'),('Nrx','H'),('Nvalid','H'),('SampleRate','f'),('Dscale','I')])
+    ntx_file_dtype = _byteorders([('TiltAngle','h'),('Focusing','H'),('Pulse','f'),('Delay','f'),
+        ('Frequency','f'),('AbsorptionCoef','H'),('WaveformID','B'),
+        ('TransmitSector#','B'),('Bandwidth','f')])
+    nrx_file_dtype = _byteorders([('BeamPointingAngle','h'),('TransmitSectorID','B'),('DetectionInfo','B'),
+        ('WindowLength','H'),('QualityFactor','B'),('Dcorr','b'),('TravelTime','f'),
+        ('Reflectivity','h'),('CleaningInfo','b'),('Spare','B')])
+    # degrees, meters and dB/km
+    ntx_scale = {'TiltAngle':0.01, 'Focusing':0.1, 'AbsorptionCoef':0.01}
+    # degrees and dB
+    nrx_scale = {'BeamPointingAngle':0.01, 'Reflectivity':0.1}
     
-    def __init__(self, datablock, byteswap = False):
+    def __init__(self, datablock, byteswap = False, lazy = False):
         """Catches the binary datablock and decodes the first section and calls
-        the decoder for the rest of the record."""
-        hdr_dtype = np.dtype([('Counter','H'),('Serial#','H'),('SoundSpeed','H'),
-            ('Ntx','H'),('Nrx','H'),('Nvalid','H'),('SampleRate','f'),('Dscale','I')])
+        the decoder for the rest of the record.  With 'lazy' the 'tx' and
+        'rx' arrays are scaledarrays."""
+        self.byteswap = byteswap
+        self.lazy = lazy
+        hdr_dtype = Data78.hdr_file_dtype[byteswap]
         hdr_sz = hdr_dtype.itemsize
         self.header = np.frombuffer(datablock[:hdr_sz], dtype=hdr_dtype)[0]
         self.header = self.header.astype(Data78.hdr_dtype)
@@ -757,25 +1846,17 @@ class Data78:
 
     def read(self, datablock):
         """Decodes the repeating parts of the record."""
-        ntx_file_dtype = np.dtype([('TiltAngle','h'),('Focusing','H'),('Pulse','f'),('Delay','f'),
-            ('Frequency','f'),('AbsorptionCoef','H'),('WaveformID','B'),
-            ('TransmitSector#','B'),('Bandwidth','f')])
+        ntx_file_dtype = Data78.ntx_file_dtype[self.byteswap]
         ntx_file_sz = ntx_file_dtype.itemsize
-        nrx_file_dtype = np.dtype([('BeamPointingAngle','h'),('TransmitSectorID','B'),('DetectionInfo','B'),
-            ('WindowLength','H'),('QualityFactor','B'),('Dcorr','b'),('TravelTime','f'),
-            ('Reflectivity','h'),('CleaningInfo','b'),('Spare','B')])
-        nrx_file_sz = nrx_file_dtype.itemsize
         ntx = self.header[3]
-        nrx = self.header[4]
         self.tx = np.frombuffer(datablock[:ntx*ntx_file_sz], dtype = ntx_file_dtype)
-        self.tx = self.tx.astype(Data78.ntx_dtype)
-        self.tx['TiltAngle'] *= 0.01  # convert to degrees
-        self.tx['Focusing'] *= 0.1   # convert to meters
-        self.tx['AbsorptionCoef'] *= 0.01  # convert to dB/km
-        self.rx = np.frombuffer(datablock[ntx*ntx_file_sz:-1], dtype = nrx_file_dtype)
-        self.rx = self.rx.astype(Data78.nrx_dtype)
-        self.rx['BeamPointingAngle'] *= 0.01  # convert to degrees
-        self.rx['Reflectivity'] *= 0.1   # convert to dB
+        self.tx = scaledarray(self.tx, Data78.ntx_dtype, Data78.ntx_scale)
+        self.rx = np.frombuffer(datablock[ntx*ntx_file_sz:-1],
+            dtype = Data78.nrx_file_dtype[self.byteswap])
+        self.rx = scaledarray(self.rx, Data78.nrx_dtype, Data78.nrx_scale)
+        if not self.lazy:
+            self.tx = self.tx.toarray()
+            self.rx = self.rx.toarray()
         
     def display(self):
         """
@@ -792,14 +1873,17 @@ class Data79:
     hdr_dtype = np.dtype([('PingCounter','H'),('SystemSerial#','H'),
         ('Nrx','H'),('Npar','H')]) # The data format has a Spare Byte here...
     qf_dtype = np.dtype([('QualityFactor','f4')])
+    hdr_file_dtype = _byteorders(hdr_dtype)
+    qf_file_dtype = _byteorders(qf_dtype)
     
     def __init__(self, datablock, byteswap = False):
         """
         Catches the binary datablock and decodes the first section and calls
         the decoder for the rest of the record.
         """
+        self.byteswap = byteswap
         hdr_sz = Data79.hdr_dtype.itemsize
-        self.header = np.frombuffer(datablock[:hdr_sz], dtype = Data79.hdr_dtype)[0]
+        self.header = np.frombuffer(datablock[:hdr_sz], dtype = Data79.hdr_file_dtype[byteswap])[0]
         if self.header['Npar'] > 1:
             print "Warning: Datagram has expanded and may not parse correctly."
         self.read(datablock[hdr_sz:-1])
@@ -808,15 +1892,16 @@ class Data79:
         """
         Reads the Quality Factor Datagram.
         """
+        qf_file_dtype = Data79.qf_file_dtype[self.byteswap]
         if self.header['Npar'] == 1:
-            self.data = np.frombuffer(datablock, dtype = Data79.qf_dtype)
+            self.data = np.frombuffer(datablock, dtype = qf_file_dtype)
         else:
             print "Only parsing original IFREMER quality factor"
             step = 4 * self.header['Nrx'] * self.header['Npar']
             self.data = np.zeros(self.header['Nrx'], dtype = Data79.qf_dtype)
             for n in range(self.header['Nrx']):
                 self.data = np.frombuffer(datablock[n*step:n*step+4],
-                    dtype = Data79.qf_dtype)
+                    dtype = qf_file_dtype)
                     
     def display(self):
         """
@@ -835,23 +1920,42 @@ class Data80:
     hdr_dtype = np.dtype([('Counter','H'),('Serial#','H'),('Latitude','d'),
         ('Longitude','d'),('Quality','f'),('Speed','f'),('Course','f'),
         ('Heading','f'),('System','B'),('NumberInputBytes','B')])
+    hdr_file_dtype = _byteorders([('Counter','H'),('Serial#','H'),('Latitude','i'),
+        ('Longitude','i'),('Quality','H'),('Speed','H'),('Course','H'),
+        ('Heading','H'),('System','B'),('NumberInputBytes','B')])
+    hdr_struct = {False:struct.Struct('<HHiiHHHHBB'), True:struct.Struct('>HHiiHHHHBB')}
     
     def __init__(self, datablock, byteswap = False):
-        """Catches the binary datablock and decodes the record."""
-        hdr_dtype = np.dtype([('Counter','H'),('Serial#','H'),('Latitude','i'),
-            ('Longitude','i'),('Quality','H'),('Speed','H'),('Course','H'),
-            ('Heading','H'),('System','B'),('NumberInputBytes','B')])
-        hdr_sz = hdr_dtype.itemsize
-        self.header = np.frombuffer(datablock[:hdr_sz], dtype = hdr_dtype)[0]
+        """Catches the binary datablock and decodes the record.  The header
+        is a single record, so it is unpacked and scaled as python numbers
+        rather than through convert."""
+        hdr_sz = Data80.hdr_struct[byteswap].size
+        header = list(Data80.hdr_struct[byteswap].unpack_from(datablock))
         # read the original datagram, of which the size is the last part of the header.
-        self.origdata = datablock[hdr_sz:hdr_sz+self.header[-1]]
-        self.header = self.header.astype(Data80.hdr_dtype)
-        self.header[2] /= 20000000.  # convert to degrees
-        self.header[3] /= 10000000.  # convert to degrees
-        self.header[4] *= 0.01       # convert to meters
-        self.header[5] *= 0.01       # convert to meters/second
-        self.header[6] *= 0.01       # convert to degrees
-        self.header[7] *= 0.01       # convert to degrees
+        self.origdata = datablock[hdr_sz:hdr_sz+header[-1]]
+        if not isinstance(self.origdata, str):
+            # memory mapped datagrams arrive as uint8 arrays
+            self.origdata = self.origdata.tostring()
+        header[2] /= 20000000.  # convert to degrees
+        header[3] /= 10000000.  # convert to degrees
+        for n in range(4,8):
+            header[n] *= 0.01   # convert to meters, m/s and degrees
+        self.header = np.array(tuple(header), dtype = Data80.hdr_dtype)[()]
+        
+    @staticmethod
+    def convert(header):
+        """
+        Converts an array of headers as found in the file to the hdr_dtype
+        array.
+        """
+        header = header.astype(Data80.hdr_dtype)
+        header['Latitude'] /= 20000000.  # convert to degrees
+        header['Longitude'] /= 10000000.  # convert to degrees
+        header['Quality'] *= 0.01       # convert to meters
+        header['Speed'] *= 0.01       # convert to meters/second
+        header['Course'] *= 0.01       # convert to degrees
+        header['Heading'] *= 0.01       # convert to degrees
+        return header
         
     def display(self):
         """
@@ -879,11 +1983,12 @@ class Data82:
         ('YawAndPitchStabilization','B'),('MaxStarboardCoverage','B'),
         ('MaxStarboardSwathWidth','H'),('TransmitAlongTilt','h'),
         ('HiLoFrequencyAbsorptionCoeffRatio','B')])
+    hdr_file_dtype = _byteorders(hdr_dtype)
     
     def __init__(self, datablock, byteswap = False):
         """Catches the binary datablock and decodes the record."""
         hdr_sz = Data82.hdr_dtype.itemsize
-        self.header = np.frombuffer(datablock[:hdr_sz], dtype = Data82.hdr_dtype)[0]
+        self.header = np.frombuffer(datablock[:hdr_sz], dtype = Data82.hdr_file_dtype[byteswap])[0]
         
     def print_byte(self, field_number):
         """
@@ -917,17 +2022,21 @@ class Data83:
         ('TVGLawCrossoverAngle',"f"),('NumberValidBeams','B')])
     beaminfo_dtype = np.dtype([('BeamIndexNumber','B'),('SortingDirection','b'),
         ('#SamplesPerBeam','H'),('CenterSample#','H')])
+    hdr_file_dtype = _byteorders([('PingCounter','H'),('SystemSerial#','H'),
+        ('MeanAbsorption',"H"),('PulseLength',"H"),('RangeToNormal','H'),
+        ('StartRangeSampleOfTVG','H'),('StopRangeSampleOfTVG','H'),
+        ('NormalIncidenceBS',"b"),('ObliqueBS',"b"),('TxBeamwidth',"H"),
+        ('TVGLawCrossoverAngle',"B"),('NumberValidBeams','B')])
+    beaminfo_file_dtype = _byteorders(beaminfo_dtype)
+    sample_scale = 0.5  # check this
     
     def __init__(self, datablock, byteswap = False):
         """
         Catches the binary datablock and decodes the first section and calls
         the decoder for the rest of the record.
         """
-        hdr_dtype = np.dtype([('PingCounter','H'),('SystemSerial#','H'),
-            ('MeanAbsorption',"H"),('PulseLength',"H"),('RangeToNormal','H'),
-            ('StartRangeSampleOfTVG','H'),('StopRangeSampleOfTVG','H'),
-            ('NormalIncidenceBS',"b"),('ObliqueBS',"b"),('TxBeamwidth',"H"),
-            ('TVGLawCrossoverAngle',"B"),('NumberValidBeams','B')])
+        self.byteswap = byteswap
+        hdr_dtype = Data83.hdr_file_dtype[byteswap]
         hdr_sz = hdr_dtype.itemsize
         self.header = np.frombuffer(datablock[:hdr_sz], dtype = hdr_dtype)[0]
         self.header = self.header.astype(Data83.hdr_dtype)
@@ -942,25 +2051,46 @@ class Data83:
     
     def _read(self, datablock, numbeams):
         """
-        Reads the data section of the record.
+        Reads the data section of the record.  The samples for all beams
+        follow the beam info block back to back, so they are kept as one
+        flat int8 array, 'rawsamples', in their raw units.  The samples for
+        beam n are rawsamples[sampleoffsets[n]:sampleoffsets[n+1]].  Use
+        getbeam for the scaled samples of one beam or getdense for a padded
+        (beams, samples) array.
         """
-        beaminfo_sz = Data89.beaminfo_dtype.itemsize
-        samples_dtype = np.dtype([('Amplitude',"b")])    
-        samples_sz = samples_dtype.itemsize
+        beaminfo_sz = Data83.beaminfo_dtype.itemsize
         p = beaminfo_sz*numbeams
         self.beaminfo = np.frombuffer(datablock[:p],
-            dtype = Data89.beaminfo_dtype)
-        maxsamples = self.beaminfo['#SamplesPerBeam'].max()
-        self.samples = np.zeros((numbeams,maxsamples), dtype = 'float')
-        for n in range(numbeams):
-            numsamples = self.beaminfo[n]['#SamplesPerBeam']
-            temp = np.frombuffer(datablock[p:p+numsamples*samples_sz],
-                dtype = samples_dtype)
-            p += numsamples*samples_sz
-            #startsample = self.beaminfo[n]['CenterSample#']
-            self.samples[n,:numsamples] = temp.astype('float')[:]
-        self.samples *= 0.5  # check this
-
+            dtype = Data83.beaminfo_file_dtype[self.byteswap])
+        numsamples = self.beaminfo['#SamplesPerBeam'].astype(np.int64)
+        self.sampleoffsets = np.zeros(numbeams + 1, dtype = np.int64)
+        np.cumsum(numsamples, out = self.sampleoffsets[1:])
+        totalsamples = self.sampleoffsets[-1]
+        self.rawsamples = np.frombuffer(datablock[p:p+totalsamples],
+            dtype = np.int8).copy()
+        
+    def getbeam(self, beamnum):
+        """
+        Returns the samples for the provided beam number in dB.
+        """
+        start, stop = self.sampleoffsets[beamnum:beamnum+2]
+        return self.rawsamples[start:stop] * Data83.sample_scale
+        
+    def getdense(self):
+        """
+        Returns a (beams, samples) array of the samples in dB padded with
+        zeros to the longest beam.
+        """
+        return _pad_ragged(self.rawsamples, self.sampleoffsets,
+            Data83.sample_scale)
+        
+    @property
+    def samples(self):
+        """
+        The (beams, samples) array of getdense, kept for scripts written
+        before the samples were held flat.  It is made each time it is used.
+        """
+        return self.getdense()
         
     def display(self):
         """
@@ -978,18 +2108,19 @@ class Data85:
     hdr_dtype = np.dtype([('ProfileCounter','H'),('SystemSerial#','H'),
         ('Date','I'),('Time',"d"),('NumEntries','H'),('DepthResolution','H')])
     data_dtype = np.dtype([('Depth','d'),('SoundSpeed','f')])
+    hdr_file_dtype = _byteorders([('ProfileCounter','H'),('SystemSerial#','H'),
+        ('Date','I'),('Time',"I"),('NumEntries','H'),
+        ('DepthResolution','H')])
+    data_file_dtype = _byteorders([('Depth','I'),('SoundSpeed','I')])
     
     def __init__(self, datablock, byteswap = False):
         """
         Catches the binary datablock and decodes the first section and calls
         the decoder for the rest of the record.
         """
-        hdr_dtype = np.dtype([('ProfileCounter','H'),('SystemSerial#','H'),
-            ('Date','I'),('Time',"I"),('NumEntries','H'),
-            ('DepthResolution','H')])
+        hdr_dtype = Data85.hdr_file_dtype[byteswap]
         hdr_sz = hdr_dtype.itemsize
-        data_dtype = np.dtype([('Depth','I'),('SoundSpeed','I')])
-        data_sz = data_dtype.itemsize
+        data_dtype = Data85.data_file_dtype[byteswap]
         self.header = np.frombuffer(datablock[:hdr_sz], 
             dtype = hdr_dtype)[0]
         self.header = self.header.astype(Data85.hdr_dtype)
@@ -1046,13 +2177,22 @@ class Data88:
     xyz_dtype = np.dtype([('Depth','f'),('AcrossTrack','f'),('AlongTrack','f'),
         ('WindowLength','H'),('QualityFactor','B'),('IncidenceAngleAdjustment','f'),
         ('Detection','B'),('Cleaning','b'),('Reflectivity','f')])
+    hdr_file_dtype = _byteorders([('Counter','H'),('Serial#','H'),('Heading','H'),
+        ('SoundSpeed','H'),('TransmitDepth','f'),('NumBeams','H'),
+        ('NumValid','H'),('SampleFrequency','f'),('Spare','i')])
+    xyz_file_dtype = _byteorders([('Depth','f'),('AcrossTrack','f'),('AlongTrack','f'),
+        ('WindowLength','H'),('QualityFactor','B'),('IncidenceAngleAdjustment','b'),
+        ('Detection','B'),('Cleaning','b'),('Reflectivity','h')])
+    # degrees and dB
+    xyz_scale = {'IncidenceAngleAdjustment':0.1, 'Reflectivity':0.1}
     
-    def __init__(self, datablock, byteswap = False):
+    def __init__(self, datablock, byteswap = False, lazy = False):
         """Catches the binary datablock and decodes the first section and calls
-        the decoder for the rest of the record."""
-        hdr_file_dtype = np.dtype([('Counter','H'),('Serial#','H'),('Heading','H'),
-            ('SoundSpeed','H'),('TransmitDepth','f'),('NumBeams','H'),
-            ('NumValid','H'),('SampleFrequency','f'),('Spare','i')])
+        the decoder for the rest of the record.  With 'lazy' the 'data'
+        array is a scaledarray."""
+        self.byteswap = byteswap
+        self.lazy = lazy
+        hdr_file_dtype = Data88.hdr_file_dtype[byteswap]
         hdr_sz = hdr_file_dtype.itemsize
         header = np.frombuffer(datablock[:hdr_sz], dtype = hdr_file_dtype)[0]
         self.header = header.astype(Data88.hdr_dtype)
@@ -1064,15 +2204,11 @@ class Data88:
         """
         Reads the data section of the record.
         """
-        xyz_file_dtype = np.dtype([('Depth','f'),('AcrossTrack','f'),('AlongTrack','f'),
-            ('WindowLength','H'),('QualityFactor','B'),('IncidenceAngleAdjustment','b'),
-            ('Detection','B'),('Cleaning','b'),('Reflectivity','h')])
-        xyz_sz = xyz_file_dtype.itemsize
         #buffer length goes to -1 because of the uint8 buffer before etx
-        self.data = np.frombuffer(datablock[:-1], dtype = xyz_file_dtype)
-        self.data = self.data.astype(Data88.xyz_dtype)
-        self.data['IncidenceAngleAdjustment'] *= 0.1  # convert to degrees
-        self.data['Reflectivity'] *= 0.1 # convert to dB
+        self.data = np.frombuffer(datablock[:-1], dtype = Data88.xyz_file_dtype[self.byteswap])
+        self.data = scaledarray(self.data, Data88.xyz_dtype, Data88.xyz_scale)
+        if not self.lazy:
+            self.data = self.data.toarray()
 
     def display(self):
         """
@@ -1093,14 +2229,20 @@ class Data89:
         ('NumberValidBeams','H')])
     beaminfo_dtype = np.dtype([('SortingDirection','b'),('DetectionInfo','B'),
         ('#SamplesPerBeam','H'),('CenterSample#','H')])
+    samples_dtype = np.dtype('h')
+    hdr_file_dtype = _byteorders([('PingCount','H'),('SystemSerial#','H'),
+        ('SamplingFreq','f'),('RangeToNormal','H'),('NormalBackscatter',"h"),
+        ('ObliqueBackscatter',"h"),('TXBeamWidth',"H"),('TVGCrossover',"H"),
+        ('NumberValidBeams','H')])
+    beaminfo_file_dtype = _byteorders(beaminfo_dtype)
+    samples_file_dtype = _byteorders(samples_dtype)
+    sample_scale = 0.1
     
     def __init__(self, datablock, byteswap = False):
         """Catches the binary datablock and decodes the first section and calls
         the decoder for the rest of the record."""
-        hdr_dtype = np.dtype([('PingCount','H'),('SystemSerial#','H'),
-            ('SamplingFreq','f'),('RangeToNormal','H'),('NormalBackscatter',"h"),
-            ('ObliqueBackscatter',"h"),('TXBeamWidth',"H"),('TVGCrossover',"H"),
-            ('NumberValidBeams','H')])
+        self.byteswap = byteswap
+        hdr_dtype = Data89.hdr_file_dtype[byteswap]
         hdr_sz = hdr_dtype.itemsize
         self.header = np.frombuffer(datablock[:hdr_sz], dtype = hdr_dtype)[0]
         self.header = self.header.astype(Data89.hdr_dtype)
@@ -1113,24 +2255,47 @@ class Data89:
     
     def _read(self, datablock, numbeams):
         """
-        Reads the data section of the record.
+        Reads the data section of the record.  The samples for all beams
+        follow the beam info block back to back, so they are kept as one
+        flat int16 array, 'rawsamples', in their raw units.  The samples for
+        beam n are rawsamples[sampleoffsets[n]:sampleoffsets[n+1]].  Use
+        getbeam for the scaled samples of one beam or getdense for a padded
+        (beams, samples) array.
         """
         beaminfo_sz = Data89.beaminfo_dtype.itemsize
-        samples_dtype = np.dtype([('Amplitude',"h")])    
-        samples_sz = samples_dtype.itemsize
+        samples_sz = Data89.samples_dtype.itemsize
         p = beaminfo_sz*numbeams
         self.beaminfo = np.frombuffer(datablock[:p],
-            dtype = Data89.beaminfo_dtype)
-        maxsamples = self.beaminfo['#SamplesPerBeam'].max()
-        self.samples = np.zeros((numbeams,maxsamples), dtype = 'float')
-        for n in range(numbeams):
-            numsamples = self.beaminfo[n]['#SamplesPerBeam']
-            temp = np.frombuffer(datablock[p:p+numsamples*samples_sz],
-                dtype = samples_dtype)
-            p += numsamples*samples_sz
-            #startsample = self.beaminfo[n]['CenterSample#']
-            self.samples[n,:numsamples] = temp.astype('float')[:]
-        self.samples *= 0.1
+            dtype = Data89.beaminfo_file_dtype[self.byteswap])
+        numsamples = self.beaminfo['#SamplesPerBeam'].astype(np.int64)
+        self.sampleoffsets = np.zeros(numbeams + 1, dtype = np.int64)
+        np.cumsum(numsamples, out = self.sampleoffsets[1:])
+        totalsamples = self.sampleoffsets[-1]
+        self.rawsamples = np.frombuffer(datablock[p:p+totalsamples*samples_sz],
+            dtype = Data89.samples_file_dtype[self.byteswap]).astype(Data89.samples_dtype)
+        
+    def getbeam(self, beamnum):
+        """
+        Returns the samples for the provided beam number in dB.
+        """
+        start, stop = self.sampleoffsets[beamnum:beamnum+2]
+        return self.rawsamples[start:stop] * Data89.sample_scale
+        
+    def getdense(self):
+        """
+        Returns a (beams, samples) array of the samples in dB padded with
+        zeros to the longest beam.
+        """
+        return _pad_ragged(self.rawsamples, self.sampleoffsets,
+            Data89.sample_scale)
+        
+    @property
+    def samples(self):
+        """
+        The (beams, samples) array of getdense, kept for scripts written
+        before the samples were held flat.  It is made each time it is used.
+        """
+        return self.getdense()
         
     def display(self):
         """
@@ -1155,16 +2320,30 @@ class Data102:
     nrx_dtype = np.dtype([('BeamPointingAngle',"f"),('Range',"f"),
         ('TransmitSectorID','B'),('Reflectivity',"f"),('QualityFactor','B'),
         ('DetectionWindowLength','B'),('BeamNumber','h'),('Spare','H')])
+    hdr_file_dtype = _byteorders([('PingCounter','H'),('SystemSerial#','H'),
+        ('Ntx','H'),('Nrx','H'),('SamplingFrequency',"I"),('Depth',"i"),
+        ('SoundSpeed',"H"),('MaximumBeams','H'),('Spare1','H'),
+        ('Spare2','H')])
+    ntx_file_dtype = _byteorders([('TiltAngle',"h"),('FocusRange',"H"),
+        ('SignalLength',"I"),('Delay',"I"),
+        ('CenterFrequency','I'),('Bandwidth',"H"),('SignalWaveformID','B'),
+        ('TransmitSector#','B')])
+    nrx_file_dtype = _byteorders([('BeamPointingAngle',"h"),('Range',"H"),
+        ('TransmitSectorID','B'),('Reflectivity',"b"),('QualityFactor','B'),
+        ('DetectionWindowLength','B'),('BeamNumber','h'),('Spare','H')])
+    ntx_scale = {'TiltAngle':0.01, 'FocusRange':0.1, 'SignalLength':10**-6,
+        'Delay':10**-6, 'Bandwidth':10}
+    nrx_scale = {'BeamPointingAngle':0.01, 'Range':0.25, 'Reflectivity':0.5}
    
-    def __init__(self, datablock, byteswap = False):
+    def __init__(self, datablock, byteswap = False, lazy = False):
         """
         Catches the binary datablock and decodes the first section and calls
-        the decoder for the rest of the record.
+        the decoder for the rest of the record.  With 'lazy' the 'tx' and
+        'rx' arrays are scaledarrays.
         """
-        hdr_dtype = np.dtype([('PingCounter','H'),('SystemSerial#','H'),
-            ('Ntx','H'),('Nrx','H'),('SamplingFrequency',"I"),('Depth',"i"),
-            ('SoundSpeed',"H"),('MaximumBeams','H'),('Spare1','H'),
-            ('Spare2','H')])
+        self.byteswap = byteswap
+        self.lazy = lazy
+        hdr_dtype = Data102.hdr_file_dtype[byteswap]
         hdr_sz = hdr_dtype.itemsize
         self.header = np.frombuffer(datablock[:hdr_sz], dtype = hdr_dtype)[0]
         self.header = self.header.astype(Data102.hdr_dtype)
@@ -1178,34 +2357,20 @@ class Data102:
         Reads the data section of the record and converts values to whole
         units.
         """
-        # declare ntx stuff
-        ntx_dtype = np.dtype([('TiltAngle',"h"),('FocusRange',"H"),
-            ('SignalLength',"I"),('Delay',"I"),
-            ('CenterFrequency','I'),('Bandwidth',"H"),('SignalWaveformID','B'),
-            ('TransmitSector#','B')])
-        ntx_sz = ntx_dtype.itemsize
+        ntx_file_dtype = Data102.ntx_file_dtype[self.byteswap]
+        ntx_sz = ntx_file_dtype.itemsize
         ntx = self.header['Ntx']
-        # declare nrx stuff
-        nrx_dtype = np.dtype([('BeamPointingAngle',"h"),('Range',"H"),
-            ('TransmitSectorID','B'),('Reflectivity',"b"),('QualityFactor','B'),
-            ('DetectionWindowLength','B'),('BeamNumber','h'),('Spare','H')])
-        nrx_sz = nrx_dtype.itemsize
-        nrx = self.header['Nrx']
         # read ntx
         self.tx = np.frombuffer(datablock[:ntx * ntx_sz], 
-            dtype = ntx_dtype)
-        self.tx = self.tx.astype(Data102.ntx_dtype)
-        self.tx['TiltAngle'] *= 0.01
-        self.tx['FocusRange'] *= 0.1
-        self.tx['SignalLength'] *= 10**-6
-        self.tx['Delay'] *= 10**-6
-        self.tx['Bandwidth'] *= 10
+            dtype = ntx_file_dtype)
+        self.tx = scaledarray(self.tx, Data102.ntx_dtype, Data102.ntx_scale)
         # read nrx
-        self.rx = np.frombuffer(datablock[ntx * ntx_sz:], dtype = nrx_dtype)
-        self.rx = self.rx.astype(Data102.nrx_dtype)
-        self.rx['BeamPointingAngle'] *= 0.01
-        self.rx['Range'] *= 0.25
-        self.rx['Reflectivity'] *= 0.5
+        self.rx = np.frombuffer(datablock[ntx * ntx_sz:],
+            dtype = Data102.nrx_file_dtype[self.byteswap])
+        self.rx = scaledarray(self.rx, Data102.nrx_dtype, Data102.nrx_scale)
+        if not self.lazy:
+            self.tx = self.tx.toarray()
+            self.rx = self.rx.toarray()
         
     def display(self):
         """
@@ -1228,20 +2393,29 @@ class Data107:
         ('TVGoffset','b'),('ScanningInfo','B'),('Spare','3B')])
     ntx_dtype = np.dtype([('TiltTx',"f"),('CenterFrequency',"I"),
         ('TransmitSector#','B'),('Spare','B')])
-    nrx_dtype = np.dtype([('BeamPointingAngle',"h"),('StartRangeSample#','H'),
+    nrx_dtype = np.dtype([('BeamPointingAngle',"f"),('StartRangeSample#','H'),
         ('NumberSamples','H'),('DetectedRange','H'),('TransmitSector#','B'),
         ('Beam#','B')])
+    hdr_file_dtype = _byteorders([('PingCounter','H'),('SystemSerial#','H'),
+        ('#OfDatagrams','H'),('Datagram#','H'),('#TxSectors','H'),
+        ('Total#Beams','H'),('NumberBeamsInDatagram','H'),('SoundSpeed',"H"),
+        ('SamplingFrequency',"I"),('TxHeave',"h"),('TVGfunction','B'),
+        ('TVGoffset','b'),('ScanningInfo','B'),('Spare','3B')])
+    ntx_file_dtype = _byteorders([('TiltTx',"h"),('CenterFrequency',"H"),
+        ('TransmitSector#','B'),('Spare','B')])
+    nrx_file_dtype = _byteorders([('BeamPointingAngle',"h"),
+        ('StartRangeSample#','H'),('NumberSamples','H'),
+        ('DetectedRange','H'),('TransmitSector#','B'),
+        ('Beam#','B')])
+    numsamples_struct = {False:struct.Struct('<H'), True:struct.Struct('>H')}
         
     def __init__(self, datablock, byteswap = False):
         """
         Catches the binary datablock and decodes the first section and calls
         the decoder for the rest of the record.
         """
-        hdr_dtype = np.dtype([('PingCounter','H'),('SystemSerial#','H'),
-            ('#OfDatagrams','H'),('Datagram#','H'),('#TxSectors','H'),
-            ('Total#Beams','H'),('NumberBeamsInDatagram','H'),('SoundSpeed',"H"),
-            ('SamplingFrequency',"I"),('TxHeave',"h"),('TVGfunction','B'),
-            ('TVGoffset','b'),('ScanningInfo','B'),('Spare','3B')])
+        self.byteswap = byteswap
+        hdr_dtype = Data107.hdr_file_dtype[byteswap]
         hdr_sz = hdr_dtype.itemsize
         self.header = np.frombuffer(datablock[:hdr_sz], dtype = hdr_dtype)[0]
         self.header = self.header.astype(Data107.hdr_dtype)
@@ -1252,52 +2426,51 @@ class Data107:
         
     def read(self, datablock):
         """
-        Reads the varable section of the datagram.
+        Reads the varable section of the datagram.  Each rx beam entry is
+        followed by its samples, so the sample counts are read by stepping
+        over the entries, and the entry offsets follow from their cumulative
+        sum.  The amplitudes are kept as int8 in 'ampdata', a (samples,
+        beams) array padded with zeros.  The samples of each beam are copied
+        as one contiguous slice per beam.
         """
-        # declare tx stuff
-        ntx_dtype = np.dtype([('TiltTx',"h"),('CenterFrequency',"H"),
-            ('TransmitSector#','B'),('Spare','B')])
-        ntx_sz = ntx_dtype.itemsize    
+        ntx_file_dtype = Data107.ntx_file_dtype[self.byteswap]
+        nrx_file_dtype = Data107.nrx_file_dtype[self.byteswap]
+        ntx_sz = ntx_file_dtype.itemsize
         ntx = self.header[4]
-        # declare rx stuff
-        nrx_dtype = np.dtype([('BeamPointingAngle',"h"),
-            ('StartRangeSample#','H'),('NumberSamples','H'),
-            ('DetectedRange','H'),('TransmitSector#','B'),
-            ('Beam#','B')])
-        nrx_sz = nrx_dtype.itemsize
+        nrx_sz = nrx_file_dtype.itemsize
         nrx = self.header[6]
-        self.rx = np.zeros(nrx, dtype = nrx_dtype)
-        # declare amplitudes stuff
-        numamp = len(datablock) - ntx_sz * ntx - nrx_sz * nrx
-        amp_dtype = np.dtype([('SampleAmplitude',"b")])
-        tempamp = np.zeros(numamp, dtype = amp_dtype)
         # get the tx data
-        self.tx = np.frombuffer(datablock[:ntx*ntx_sz], dtype = ntx_dtype)
-        p = ntx*ntx_sz
+        self.tx = np.frombuffer(datablock[:ntx*ntx_sz], dtype = ntx_file_dtype)
         self.tx = self.tx.astype(Data107.ntx_dtype)
         self.tx['TiltTx'] *= 0.01
         self.tx['CenterFrequency'] *= 10
-        # get the rx and amplitude data
-        pamp = 0
+        # find the number of samples for each beam, which sets where the
+        # next beam entry starts
+        unpack = Data107.numsamples_struct[self.byteswap].unpack_from
+        numsamples_offset = nrx_file_dtype.fields['NumberSamples'][1]
+        numsamples = []
+        p = ntx*ntx_sz
         for n in range(nrx):
-            self.rx[n] = np.frombuffer(datablock[p:p+nrx_sz], 
-                dtype = nrx_dtype)
-            p += nrx_sz
-            # the number of samples for this beam
-            beamsz = self.rx[n][2]
-            tempamp[pamp:pamp+beamsz] = \
-                np.frombuffer(datablock[p:p+beamsz], dtype = amp_dtype)
-            p += beamsz
-            pamp += beamsz
+            count = unpack(datablock, p + numsamples_offset)[0]
+            numsamples.append(count)
+            p += nrx_sz + count
+        numsamples = np.array(numsamples, dtype = np.int64)
+        samplestart = np.cumsum(numsamples) - numsamples
+        rxstart = ntx*ntx_sz + np.arange(nrx) * nrx_sz + samplestart
+        data = np.frombuffer(datablock[:p], dtype = np.uint8)
+        # get the rx data
+        rxbytes = data[rxstart[:,np.newaxis] + np.arange(nrx_sz)]
+        self.rx = rxbytes.view(nrx_file_dtype).reshape(-1)
         self.rx = self.rx.astype(Data107.nrx_dtype)
         self.rx['BeamPointingAngle'] *= 0.01
-        # unwined the beam data into an array
-        numsamples = self.rx['NumberSamples']
-        self.ampdata = np.zeros((numsamples.max(), nrx))
-        pamp = 0
-        for n in range(nrx):
-            self.ampdata[:numsamples[n],n] = tempamp[pamp:pamp+numsamples[n]]
-            pamp += numsamples[n]
+        # copy the run of samples following each rx entry into a row of a
+        # (beams, samples) array
+        maxsamples = numsamples.max() if nrx > 0 else 0
+        ampdata = np.zeros((nrx, maxsamples), dtype = np.int8)
+        samples = data.view(np.int8)
+        for n, start, count in zip(range(nrx), (rxstart + nrx_sz).tolist(), numsamples.tolist()):
+            ampdata[n,:count] = samples[start:start+count]
+        self.ampdata = ampdata.T
         
     def display(self):
         """
@@ -1319,17 +2492,19 @@ class Data109:
         ('SoundSpeed',"f"),('StartRangeRefTx','H'),('TotalSample','H'),
         ('#SamplesInDatagram','H'),('Stave#','H'),('#StavesPerSample','H'),
         ('RangeToNormal','H'),('Spare','H')])
+    hdr_file_dtype = _byteorders([('PingCounter','H'),('SystemSerial#','H'),
+        ('#Datagrams','H'),('Datagram#','H'),('RxSamplingFrequency',"I"),
+        ('SoundSpeed',"H"),('StartRangeRefTx','H'),('TotalSample','H'),
+        ('#SamplesInDatagram','H'),('Stave#','H'),('#StavesPerSample','H'),
+        ('RangeToNormal','H'),('Spare','H')])
         
     def __init__(self, datablock, byteswap = False):
         """
         Catches the binary datablock and decodes the first section and calls
         the decoder for the rest of the record.
         """
-        hdr_dtype = np.dtype([('PingCounter','H'),('SystemSerial#','H'),
-            ('#Datagrams','H'),('Datagram#','H'),('RxSamplingFrequency',"I"),
-            ('SoundSpeed',"H"),('StartRangeRefTx','H'),('TotalSample','H'),
-            ('#SamplesInDatagram','H'),('Stave#','H'),('#StavesPerSample','H'),
-            ('RangeToNormal','H'),('Spare','H')])
+        self.byteswap = byteswap
+        hdr_dtype = Data109.hdr_file_dtype[byteswap]
         hdr_sz = hdr_dtype.itemsize
         self.header = np.frombuffer(datablock[:hdr_sz],
             dtype = hdr_dtype)[0]
@@ -1348,8 +2523,8 @@ class Data109:
         Ne = self.header['#StavesPerSample']
         read_fmt = str(Ne) + 'b'
         used_fmt = str(Ne) + 'f'
-        read_dtype = np.dtype([('Sample#','H'),('TvgGain',"h"),
-            ('StaveBackscatter',read_fmt)])
+        read_dtype = _byteorders([('Sample#','H'),('TvgGain',"h"),
+            ('StaveBackscatter',read_fmt)])[self.byteswap]
         read_sz = read_dtype.itemsize
         used_dtype = np.dtype([('Sample#','H'),('TvgGain',"f"),
             ('StaveBackscatter',read_fmt)])
@@ -1376,36 +2551,110 @@ class Data110:
     
     hdr_dtype = np.dtype([('Counter','H'),('Serial#','H'),('NumEntries','H'),
         ('Sensor','B'),('Spare','B')])
+    hdr_file_dtype = _byteorders(hdr_dtype)
     att_dtype = np.dtype([('Time','d'),('Roll','f'),('Pitch','f'),('Heave','f'),
         ('Heading','f')])
+    att_file_dtype = _byteorders([('Time','H'),('Roll','h'),('Pitch','h'),('Heave','h'),
+        ('Heading','H'),('NumBytesInput','B')])
+    att_scale = {'Time':0.001, 'Roll':0.01, 'Pitch':0.01, 'Heave':0.01,
+        'Heading':0.01}
+    numbytes_struct = struct.Struct('<B')
     
-    def __init__(self, datablock, POSIXtime, byteswap = False):
+    def __init__(self, datablock, POSIXtime, byteswap = False, lazy = False):
         """Catches the binary datablock and decodes the first section and calls
-        the decoder for the rest of the record."""
+        the decoder for the rest of the record.  With 'lazy' the 'data'
+        array is a scaledarray."""
         hdr_sz = Data110.hdr_dtype.itemsize
         self.time = POSIXtime
-        self.header = np.frombuffer(datablock[:hdr_sz], dtype = Data110.hdr_dtype)[0]
+        self.byteswap = byteswap
+        self.lazy = lazy
+        self.header = np.frombuffer(datablock[:hdr_sz], dtype = Data110.hdr_file_dtype[byteswap])[0]
         self.read(datablock[hdr_sz:])
         
     def read(self, datablock):
         """Reads the data section of the record.  Time is POSIX time,
-        angles are in degrees, distances in meters."""
-        att_file_dtype = np.dtype([('Time','H'),('Roll','h'),('Pitch','h'),('Heave','h'),
-            ('Heading','H'),('NumBytesInput','B')])
-        att_sz = att_file_dtype.itemsize
+        angles are in degrees, distances in meters.  Each entry is followed
+        by NumBytesInput bytes of raw sensor input, so the entry offsets are
+        found by find_offsets, and the entries are then pulled out of the
+        datablock together."""
         self.numrecords = self.header[2]
-        self.data = np.zeros(self.numrecords, dtype = Data110.att_dtype)
-        datap = 0
-        for i in range(self.numrecords):
-            temp = np.frombuffer(datablock[datap:att_sz+datap],
-                dtype = att_file_dtype)
-            datap += att_sz + temp['NumBytesInput'][0]
-            self.data[i] = temp[['Time','Roll','Pitch','Heave', 'Heading']].astype(Data110.att_dtype)
-        self.data['Time'] = self.data['Time'] * 0.001 + self.time
-        self.data['Roll'] *= 0.01
-        self.data['Pitch'] *= 0.01
-        self.data['Heave'] *= 0.01
-        self.data['Heading'] *= 0.01
+        data = np.frombuffer(datablock, dtype = np.uint8)
+        offsets = Data110.find_offsets(data, [0], [self.numrecords])
+        self.data = Data110.convert(Data110.gather(data, offsets, self.byteswap),
+            self.time, self.lazy)
+        
+    @staticmethod
+    def find_offsets(data, starts, counts):
+        """
+        Returns an array of the offsets into the uint8 array 'data' of the
+        entries of a number of datagrams, whose entries begin at 'starts'
+        and number 'counts'.  The entries of a datagram are taken to be
+        spaced by the size of the first entry and its sensor input, and the
+        NumBytesInput of every entry is checked against that of the first.
+        Only the datagrams where they differ are walked entry by entry with
+        entry_offsets.
+        """
+        att_sz = Data110.att_file_dtype[False].itemsize
+        numbytes_offset = Data110.att_file_dtype[False].fields['NumBytesInput'][1]
+        starts = np.asarray(starts, dtype = np.int64)
+        counts = np.asarray(counts, dtype = np.int64)
+        first = np.cumsum(counts) - counts
+        owner = np.repeat(np.arange(len(counts)), counts)
+        stride = np.zeros(len(counts), dtype = np.int64)
+        some = np.nonzero(counts > 0)[0]
+        stride[some] = data[starts[some] + numbytes_offset].astype(np.int64) + att_sz
+        offsets = starts[owner] + (np.arange(len(owner)) - first[owner]) * stride[owner]
+        inside = offsets + att_sz <= len(data)
+        numbytes = np.zeros(len(owner), dtype = np.int64)
+        numbytes[inside] = data[offsets[inside] + numbytes_offset]
+        uneven = ~inside | (numbytes + att_sz != stride[owner])
+        for n in np.unique(owner[uneven]).tolist():
+            offsets[first[n]:first[n] + counts[n]] = Data110.entry_offsets(data,
+                int(starts[n]), int(counts[n]))
+        return offsets
+        
+    @staticmethod
+    def entry_offsets(buf, start, numentries, offsets = None):
+        """
+        Returns a list of the offsets into buf of the 'numentries' entries
+        beginning at 'start', appended to 'offsets' if provided.  This walks
+        the entries one at a time, for datagrams whose entries carry sensor
+        input of differing sizes.
+        """
+        if offsets is None:
+            offsets = []
+        unpack = Data110.numbytes_struct.unpack_from
+        numbytes_offset = Data110.att_file_dtype[False].fields['NumBytesInput'][1]
+        att_sz = Data110.att_file_dtype[False].itemsize
+        p = start
+        for i in range(numentries):
+            offsets.append(p)
+            p += att_sz + unpack(buf, p + numbytes_offset)[0]
+        return offsets
+        
+    @staticmethod
+    def gather(data, offsets, byteswap = False):
+        """
+        Returns the entries at the provided offsets into the uint8 array
+        'data' as an att_file_dtype array.
+        """
+        att_file_dtype = Data110.att_file_dtype[byteswap]
+        offsets = np.asarray(offsets, dtype = np.int64)
+        raw = data[offsets[:,np.newaxis] + np.arange(att_file_dtype.itemsize)]
+        return raw.view(att_file_dtype).reshape(-1)
+        
+    @staticmethod
+    def convert(data, POSIXtime, lazy = False):
+        """
+        Converts an array of entries as found in the file to the att_dtype
+        array, or with 'lazy' a scaledarray.  POSIXtime is the datagram
+        time, or an array of the datagram time for each entry.
+        """
+        data = scaledarray(data, Data110.att_dtype, Data110.att_scale,
+            {'Time':POSIXtime})
+        if lazy:
+            return data
+        return data.toarray()
         
     def display(self):
         """
@@ -1415,13 +2664,65 @@ class Data110:
             print name + ' : ' + str(self.header[n])
             
             
+def register_decoder(recordtype, decoder, args = ('byteswap',)):
+    """
+    Sets the decoder used by Datagram.decode for datagrams of the given
+    type.  The decoder is called with the datablock followed by the
+    Datagram attributes named in 'args', such as 'time', 'byteswap' and
+    'lazy', and the result is stored as the packet's subpack.  For
+    example the remote installation parameters can be decoded with
+    register_decoder(112, Data73).
+    """
+    Datagram.decoders[int(recordtype)] = (decoder, tuple(args))
+    
+    
+register_decoder(49, Data49)
+register_decoder(65, Data65, ('time', 'byteswap', 'lazy'))
+register_decoder(67, Data67)
+register_decoder(68, Data68)
+register_decoder(71, Data71, ('time', 'byteswap', 'lazy'))
+register_decoder(73, Data73)
+register_decoder(78, Data78, ('byteswap', 'lazy'))
+register_decoder(79, Data79)
+register_decoder(80, Data80)
+register_decoder(82, Data82)
+register_decoder(83, Data83)
+register_decoder(85, Data85)
+register_decoder(88, Data88, ('byteswap', 'lazy'))
+register_decoder(89, Data89)
+register_decoder(102, Data102, ('byteswap', 'lazy'))
+#same definition for this data type
+register_decoder(105, Data73)
+register_decoder(107, Data107)
+register_decoder(109, Data109)
+register_decoder(110, Data110, ('time', 'byteswap', 'lazy'))
+            
+            
 class mappack:
     """
-    Container for the file packet map.
+    Container for the file packet map.  The map is saved as a binary index
+    made up of a header, a section table and the data for each section.
+    The header records the size and modification time of the mapped file
+    so that an out of date index can be detected.  Each record type is a
+    section holding the (N, 2) float64 array of location and time found in
+    the packdir, and sections not named by a record type are kept in the
+    'aux' dictionary.  All sections are memory mapped when loaded.
     """
+    
+    index_magic = 'ALLINDEX'
+    index_version = 1
+    # magic, version, number of sections, source size, source mtime
+    index_hdr = struct.Struct('<8sHHQd')
+    # name, dtype string, rows, columns (0 for one dimension), offset
+    index_section = struct.Struct('<16s8sQQQ')
+    
     def __init__(self):
         """Constructor creates a packmap dictionary"""
         self.packdir = {}
+        self.aux = {}
+        self.srcsize = 0
+        self.srcmtime = 0
+        self.legacy = False
         self.dtypes = {
             68 : 'Old Depth',
             88 : 'New Depth',
@@ -1456,8 +2757,155 @@ class mappack:
     def finalize(self):
         for key in self.packdir.keys():
             temp = np.asarray(self.packdir[key])
-            tempindx = temp[:,1].argsort()
+            tempindx = temp[:,1].argsort(kind = 'mergesort')
             self.packdir[key] = temp[tempindx,:]
+            
+    def add_arrays(self, types, locations, times):
+        """
+        Builds the packdir from arrays of the type, location and time of
+        every record, sorting each type by the time stamp as finalize does.
+        """
+        for dtype in np.unique(types):
+            idx = np.nonzero(types == dtype)[0]
+            temp = np.column_stack((locations[idx], times[idx])).astype(np.float64)
+            tempindx = temp[:,1].argsort(kind = 'mergesort')
+            self.packdir[str(dtype)] = temp[tempindx,:]
+        self._build_pings()
+            
+    def append_arrays(self, types, locations, times):
+        """
+        Appends records to an existing packdir.  Records newer than those
+        already mapped for their type are added to the end, otherwise the
+        type is sorted again by time.  Returns the list of types that had to
+        be sorted again.
+        """
+        resorted = []
+        for dtype in np.unique(types):
+            key = str(dtype)
+            idx = np.nonzero(types == dtype)[0]
+            temp = np.column_stack((locations[idx], times[idx])).astype(np.float64)
+            temp = temp[temp[:,1].argsort(kind = 'mergesort'),:]
+            if not self.packdir.has_key(key):
+                self.packdir[key] = temp
+                continue
+            old = self.packdir[key]
+            temp = np.concatenate((old, temp))
+            if len(old) > 0 and temp[len(old),1] < old[-1,1]:
+                temp = temp[temp[:,1].argsort(kind = 'mergesort'),:]
+                resorted.append(key)
+            self.packdir[key] = temp
+        self._build_pings()
+        return resorted
+        
+    def _build_pings(self):
+        """
+        Makes the ping table for the water column records, which are sorted
+        by time.  Row n of the table is the index of the first record of
+        ping n and the number of records in the ping, where the records of a
+        ping share a time stamp.
+        """
+        if self.packdir.has_key('107'):
+            times = self.packdir['107'][:,1]
+            first = np.append(0, np.nonzero(np.diff(times) != 0)[0] + 1)
+            count = np.diff(np.append(first, len(times)))
+            self.aux['ping107'] = np.column_stack((first, count)).astype(np.int64)
+            
+    def getpings(self, recordtype = 107):
+        """
+        Returns the ping table for the given record type.
+        """
+        key = 'ping' + str(recordtype)
+        if not self.aux.has_key(key):
+            self._build_pings()
+        return self.aux[key]
+        
+    def gettimes(self, recordtype):
+        """
+        Returns the sorted time stamps of the given record type, which are
+        indexed by record number.  An empty array is returned for types not
+        in the map.
+        """
+        key = str(int(recordtype))
+        if not self.packdir.has_key(key) or len(self.packdir[key]) == 0:
+            return np.zeros(0)
+        return self.packdir[key][:,1]
+        
+    def getrecord_ranges(self, recordtype, t0, t1):
+        """
+        Returns the first and last plus one record numbers of the given type
+        with time stamps from t0 through t1.  t0 and t1 may be arrays of
+        window bounds, giving arrays of record ranges.
+        """
+        times = self.gettimes(recordtype)
+        first = np.searchsorted(times, t0, side = 'left')
+        last = np.searchsorted(times, t1, side = 'right')
+        return first, np.maximum(first, last)
+        
+    def getrecords_between(self, recordtype, t0, t1):
+        """
+        Returns the record numbers of the given type with time stamps from
+        t0 through t1.
+        """
+        first, last = self.getrecord_ranges(recordtype, t0, t1)
+        return np.arange(first, last)
+        
+    def nearest_records(self, recordtype, tstamps, tolerance = None):
+        """
+        Returns the record numbers of the given type nearest in time to each
+        of the time stamps, taking the earlier record when two are equally
+        near and the first record of those sharing a time stamp, such as the
+        records of a water column ping.  Times with no record, or with no
+        record within the tolerance in seconds, are given -1.
+        """
+        times = self.gettimes(recordtype)
+        tstamps = np.asarray(tstamps, dtype = np.float64)
+        if len(times) == 0:
+            return -np.ones(tstamps.shape, dtype = np.int64)
+        after = np.searchsorted(times, tstamps, side = 'left').clip(0, len(times) - 1)
+        before = (after - 1).clip(0, len(times) - 1)
+        use_after = np.abs(times[after] - tstamps) < np.abs(tstamps - times[before])
+        nearest = np.where(use_after, after, before)
+        nearest = np.searchsorted(times, times[nearest], side = 'left').astype(np.int64)
+        if tolerance is not None:
+            nearest[np.abs(times[nearest] - tstamps) > tolerance] = -1
+        return nearest
+        
+    def nearest_record(self, recordtype, tstamp, tolerance = None):
+        """
+        Returns the record number of the given type nearest in time to the
+        time stamp, or -1 if there is none within the tolerance.
+        """
+        return int(self.nearest_records(recordtype, tstamp, tolerance))
+        
+    def getrecords_in_box(self, recordtype, lat0, lat1, lon0, lon1):
+        """
+        Returns the sorted record numbers of the given type positioned
+        within latitudes lat0 through lat1 and longitudes lon0 through lon1
+        in degrees, from the position index made by allRead.build_geoindex.
+        A box across 180 degrees longitude is given with lon0 greater than
+        lon1.  Returns None if there is no position index for the type.
+        """
+        key = str(int(recordtype))
+        if not self.aux.has_key('geo' + key):
+            return None
+        if lon0 > lon1:
+            return np.union1d(self.getrecords_in_box(key, lat0, lat1, lon0, 180.),
+                self.getrecords_in_box(key, lat0, lat1, -180., lon1))
+        geo = self.aux['geo' + key]
+        lat, lon, cellsize, numrows, numcols = self.aux['geogrid' + key]
+        # the range of grid cells covering the box
+        row0, row1 = np.clip(np.floor((np.array([lat0, lat1]) - lat) / cellsize),
+            0, numrows - 1).astype(np.int64)
+        col0, col1 = np.clip(np.floor((np.array([lon0, lon1]) - lon) / cellsize),
+            0, numcols - 1).astype(np.int64)
+        rows = np.arange(row0, row1 + 1) * int(numcols)
+        first = np.searchsorted(geo[:,0], rows + col0, side = 'left')
+        last = np.searchsorted(geo[:,0], rows + col1, side = 'right')
+        idx = [np.arange(a, b) for a, b in zip(first, last)]
+        found = geo[np.concatenate([np.zeros(0, dtype = np.int64)] + idx)]
+        inside = (found[:,1] >= lat0) & (found[:,1] <= lat1) & \
+            (found[:,2] >= lon0) & (found[:,2] <= lon1)
+        return np.sort(found[inside,3].astype(np.int64))
         
     def printmap(self):
         keys = []
@@ -1468,10 +2916,44 @@ class mappack:
             dtype = self.gettype(key[0])
             print dtype + ' ' + str(key[0]) + ' (' + hex(int(key[0])) + ') has ' + str(key[1]) + ' packets'
             
-    def save(self, outfilename):
-        outfile = open(outfilename, 'wb')
-        pickle.dump(self.packdir, outfile)
+    def save(self, outfilename, srcsize = 0, srcmtime = 0):
+        """
+        Writes the packdir and aux arrays to the binary index file, recording
+        the size and modification time of the source file.
+        """
+        # an index being replaced may be memory mapped by this object
+        self._release()
+        sections = [(key, self.packdir[key]) for key in sorted(self.packdir.keys(), key = int)]
+        sections += [(key, self.aux[key]) for key in sorted(self.aux.keys())]
+        sections = [(key, np.ascontiguousarray(arr, dtype = np.asarray(arr).dtype.newbyteorder('<')))
+            for key, arr in sections]
+        offset = mappack.index_hdr.size + len(sections) * mappack.index_section.size
+        table = []
+        for key, arr in sections:
+            offset += -offset % 8
+            if arr.ndim > 1:
+                rows, cols = arr.shape
+            else:
+                rows, cols = len(arr), 0
+            table.append(mappack.index_section.pack(key, arr.dtype.str, rows, cols, offset))
+            offset += arr.nbytes
+        # write a new file and move it into place so that other readers
+        # that have the old index memory mapped are not disturbed
+        tempname = outfilename + '.tmp'
+        outfile = open(tempname, 'wb')
+        outfile.write(mappack.index_hdr.pack(mappack.index_magic,
+            mappack.index_version, len(sections), srcsize, srcmtime))
+        outfile.write(''.join(table))
+        for key, arr in sections:
+            outfile.write('\0' * (-outfile.tell() % 8))
+            outfile.write(arr.tostring())
         outfile.close()
+        if os.name == 'nt' and os.path.isfile(outfilename):
+            os.remove(outfilename)
+        os.rename(tempname, outfilename)
+        self.srcsize = srcsize
+        self.srcmtime = srcmtime
+        self.legacy = False
         
     def gettype(self, dtype):
         if self.dtypes.has_key(int(dtype)):
@@ -1481,9 +2963,298 @@ class mappack:
         return out
         
     def load(self,infilename):
+        """
+        Memory maps the binary index file.  The packdir and aux arrays are
+        views of the mapped file, and remain valid after the map is saved
+        again or closed.  Maps saved in the older pickled form are read and
+        flagged as legacy.
+        """
         infile = open(infilename, 'rb')
-        self.packdir = pickle.load(infile)
+        if infile.read(len(mappack.index_magic)) != mappack.index_magic:
+            infile.seek(0)
+            self.packdir = pickle.load(infile)
+            infile.close()
+            self.legacy = True
+            return
+        self._mm = mmap.mmap(infile.fileno(), 0, access = mmap.ACCESS_READ)
         infile.close()
+        magic, version, numsections, self.srcsize, self.srcmtime = \
+            mappack.index_hdr.unpack_from(self._mm, 0)
+        if version > mappack.index_version:
+            raise IOError('index version ' + str(version) + ' is not supported.')
+        p = mappack.index_hdr.size
+        for n in range(numsections):
+            key, dtype, rows, cols, offset = mappack.index_section.unpack_from(self._mm, p)
+            p += mappack.index_section.size
+            key = key.rstrip('\0')
+            dtype = np.dtype(dtype.rstrip('\0'))
+            count = rows * max(cols, 1)
+            if count > 0:
+                arr = np.frombuffer(self._mm, dtype = dtype, count = count, offset = offset)
+            else:
+                arr = np.zeros(count, dtype = dtype)
+            if cols > 0:
+                arr = arr.reshape(rows, cols)
+            if key.isdigit():
+                self.packdir[key] = arr
+            else:
+                self.aux[key] = arr
+        self.legacy = False
+        
+    def is_stale(self, srcsize, srcmtime):
+        """
+        Returns True if the map was saved for a file of a different size or
+        modification time than given, or if it was saved in the pickled form.
+        """
+        return self.legacy or self.srcsize != srcsize or self.srcmtime != srcmtime
+        
+    def _release(self):
+        """
+        Copies any memory mapped arrays into memory and lets go of the index
+        file so that it can be replaced.  The mapping is not closed, as
+        arrays taken from the map earlier may still be views of it; it is
+        unmapped when the last of them is freed.
+        """
+        if self.__dict__.has_key('_mm'):
+            for key in self.packdir.keys():
+                self.packdir[key] = np.array(self.packdir[key])
+            for key in self.aux.keys():
+                self.aux[key] = np.array(self.aux[key])
+            del self._mm
+            
+    def close(self):
+        """
+        Empties the map and lets go of the index file if it is memory
+        mapped.  As with _release, the mapping lasts until no arrays taken
+        from the map remain.
+        """
+        self.packdir = {}
+        self.aux = {}
+        if self.__dict__.has_key('_mm'):
+            del self._mm
+            
+            
+class surveyindex:
+    """
+    Index of the records in a set of .all files, such as the consecutive
+    files of a survey, made from the map of each file.  The maps are loaded
+    from the saved 'par' index files, and are made and saved for files that
+    have none, so the files themselves are only opened to be mapped or to
+    read a record.  Files are kept in order of their first time stamp.
+    Records are found by a binary search of the time column of each type in
+    each file that overlaps the requested times, and are returned as a
+    'record_dtype' array giving the file number, type, record number in the
+    file map, byte location and time of each record.
+    """
+    
+    record_dtype = np.dtype([('File','i4'),('Type','i4'),('Record','i8'),
+        ('Location','i8'),('Time','d')])
+    
+    def __init__(self, filenames = []):
+        """
+        Makes the index for a list of .all files or a glob pattern such as
+        'survey/*.all'.  A pattern is kept so that update can find files
+        added later.
+        """
+        self.files = []
+        self.maps = []
+        self.stats = []
+        self.spans = np.zeros((0,2))
+        self.pattern = None
+        self._reader = None
+        self._readernum = None
+        if isinstance(filenames, str):
+            self.pattern = filenames
+            filenames = glob.glob(filenames)
+        self.update(filenames)
+        
+    def update(self, filenames = None):
+        """
+        Adds the given files, or the files now matching the pattern given
+        when the index was made, that are not yet in the index.  Files
+        already in the index that have changed size or modification time
+        are mapped again, only from where the last map ended if they have
+        grown.  Returns the number of files added or mapped again.
+        """
+        if filenames is None:
+            if self.pattern is None:
+                filenames = []
+            else:
+                filenames = glob.glob(self.pattern)
+        changed = 0
+        known = dict([(os.path.abspath(name), n) for n, name in enumerate(self.files)])
+        for n, name in enumerate(self.files):
+            stat = os.stat(name)
+            if (stat.st_size, stat.st_mtime) != self.stats[n]:
+                self.maps[n], self.stats[n] = self._map_file(name, self.maps[n])
+                changed += 1
+        for name in sorted(set(filenames)):
+            if not known.has_key(os.path.abspath(name)):
+                newmap, stat = self._map_file(name)
+                self.files.append(name)
+                self.maps.append(newmap)
+                self.stats.append(stat)
+                known[os.path.abspath(name)] = len(self.files) - 1
+                changed += 1
+        if changed > 0:
+            self._sort_files()
+        return changed
+        
+    def _map_file(self, filename, oldmap = None):
+        """
+        Returns the map of the given file and its size and modification time.
+        A saved map is used if it is current, brought up to date if the
+        file has grown since, and otherwise the file is mapped again.
+        """
+        if oldmap is not None:
+            oldmap.close()
+        if self._readernum is not None and self.files[self._readernum] == filename:
+            self._reader.close()
+            self._reader = None
+            self._readernum = None
+        reader = allRead(filename)
+        reader.loadfilemap(rebuild = False)
+        if not reader.mapped:
+            reader.mapfile()
+            self._save_map(reader)
+        elif reader.map.is_stale(reader.filelen, reader.filemtime):
+            if reader.mapped_to is not None and reader.map.srcsize < reader.filelen:
+                reader.update_map()
+            else:
+                reader.map.close()
+                reader.mapped = False
+                reader.mapfile()
+            self._save_map(reader)
+        reader.close()
+        return reader.map, (reader.filelen, reader.filemtime)
+        
+    def _save_map(self, reader):
+        """
+        Saves the map of the reader, keeping it in memory only if the index
+        file cannot be written.
+        """
+        reader._save_map()
+            
+    def _sort_files(self):
+        """
+        Finds the time span of each file and orders the files by their
+        first time stamp.
+        """
+        spans = np.zeros((len(self.files), 2))
+        for n, filemap in enumerate(self.maps):
+            times = [v[:,1] for v in filemap.packdir.values() if len(v) > 0]
+            if len(times) > 0:
+                times = np.concatenate(times)
+                spans[n] = np.nanmin(times), np.nanmax(times)
+            else:
+                spans[n] = np.nan
+        order = spans[:,0].argsort(kind = 'mergesort')
+        if self._readernum is not None:
+            self._readernum = int(np.nonzero(order == self._readernum)[0][0])
+        self.files = [self.files[n] for n in order]
+        self.maps = [self.maps[n] for n in order]
+        self.stats = [self.stats[n] for n in order]
+        self.spans = spans[order]
+        
+    def getrecords_between(self, types, t0, t1):
+        """
+        Returns the records of the given type or types with time stamps from
+        t0 through t1 as a 'record_dtype' array sorted by time.
+        """
+        keys = [str(int(t)) for t in np.atleast_1d(types)]
+        parts = [np.zeros(0, dtype = surveyindex.record_dtype)]
+        overlap = np.nonzero((self.spans[:,1] >= t0) & (self.spans[:,0] <= t1))[0]
+        for n in overlap:
+            for key in keys:
+                if not self.maps[n].packdir.has_key(key):
+                    continue
+                first, last = self.maps[n].getrecord_ranges(key, t0, t1)
+                parts.append(self._make_records(n, key, np.arange(first, last)))
+        records = np.concatenate(parts)
+        return records[records['Time'].argsort(kind = 'mergesort')]
+        
+    def getrecords_in_box(self, types, lat0, lat1, lon0, lon1):
+        """
+        Returns the records of the given type or types positioned within
+        latitudes lat0 through lat1 and longitudes lon0 through lon1, in
+        degrees, as a 'record_dtype' array sorted by time.  The position
+        index of each file is made, and saved with its map, the first time
+        it is needed.
+        """
+        keys = [str(int(t)) for t in np.atleast_1d(types)]
+        parts = [np.zeros(0, dtype = surveyindex.record_dtype)]
+        for n, filemap in enumerate(self.maps):
+            for key in keys:
+                if not filemap.packdir.has_key(key):
+                    continue
+                if not filemap.aux.has_key('geo' + key):
+                    self._build_geoindex(n, key)
+                found = filemap.getrecords_in_box(key, lat0, lat1, lon0, lon1)
+                parts.append(self._make_records(n, key, found))
+        records = np.concatenate(parts)
+        return records[records['Time'].argsort(kind = 'mergesort')]
+        
+    def _make_records(self, filenum, key, recordnums):
+        """
+        Returns a 'record_dtype' array for the given records of a file.
+        """
+        records = self.maps[filenum].packdir[key]
+        part = np.zeros(len(recordnums), dtype = surveyindex.record_dtype)
+        part['File'] = filenum
+        part['Type'] = int(key)
+        part['Record'] = recordnums
+        part['Location'] = records[recordnums,0]
+        part['Time'] = records[recordnums,1]
+        return part
+        
+    def _build_geoindex(self, filenum, key):
+        """
+        Makes the position index of a record type in a file and saves it
+        with the map if the file has not changed since it was mapped.
+        """
+        reader = self._open_reader(filenum)
+        reader.build_geoindex(key)
+        if (reader.filelen, reader.filemtime) == self.stats[filenum]:
+            self._save_map(reader)
+            
+    def _open_reader(self, filenum):
+        """
+        Returns an allRead for the given file that uses the map in the
+        index.  The reader is kept open until another file is read.
+        """
+        if self._readernum != filenum:
+            if self._reader is not None:
+                self._reader.close()
+            self._reader = allRead(self.files[filenum])
+            self._reader.map = self.maps[filenum]
+            self._reader.mapped = True
+            if self.maps[filenum].aux.has_key('mapped_to'):
+                self._reader.mapped_to = int(self.maps[filenum].aux['mapped_to'][0])
+            else:
+                self._reader.mapped_to = None
+            self._readernum = filenum
+        return self._reader
+        
+    def getrecord(self, filenum, recordtype, recordnum):
+        """
+        Reads and decodes the given record of the given file, as found in
+        a 'record_dtype' array, and returns the Datagram.  The last file
+        read from is kept open.
+        """
+        reader = self._open_reader(int(filenum))
+        reader.getrecord(int(recordtype), int(recordnum))
+        return reader.packet
+        
+    def close(self):
+        """
+        Closes the open file and the maps.
+        """
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+            self._readernum = None
+        for filemap in self.maps:
+            filemap.close()
         
         
 class resolve_file_depths:
@@ -1496,6 +3267,13 @@ class resolve_file_depths:
     International Hydrographic Review, v.5, no.3, p.26-31.
     http://www.omg.unb.ca/omg/papers/beaudoin_IHR_nov2004.pdf
     """
+    
+    # bytes of decoded records kept by the file reader, so the installation
+    # parameters and recently used pings are not decoded for every ping
+    cachesize = 67108864
+    # number of sound speed casts kept parsed by raytrace
+    maxcasts = 8
+    
     def __init__(self, primaryfile, pre = None, post = None):
         """
         Open an All file, map it and make the navigation array. Maybe at some
@@ -1504,7 +3282,9 @@ class resolve_file_depths:
         """
         self.have_ssp_file = False
         self.have_patchtest = False
-        self.p = allRead(primaryfile)
+        self.casts = recordcache(resolve_file_depths.maxcasts)
+        self.cast_index = {}
+        self.p = allRead(primaryfile, cachesize = resolve_file_depths.cachesize)
         if os.path.isfile(primaryfile[:-3] + 'par'):
             self.p.loadfilemap()
         else:
@@ -1530,20 +3310,130 @@ class resolve_file_depths:
         
         self.have_patchtest = True
         
-    def resolve_all_pings(self, ssp_filename):
+    def resolve_all_pings(self, ssp_filename = None, outname = None, nproc = 1,
+            blocksize = 100, verbose = True):
+        """
+        Resolves every ping in the file into (ping, beam) arrays of the
+        time, x, y and depth of each beam, padded with NaN, which are
+        returned in that order.  The arrays are memory mapped .npy files
+        named outname + '_time.npy' and so on, where 'outname' is the file
+        name without its extension if not given, so they can be reopened
+        with np.load.  The pings are resolved in blocks of 'blocksize'.  Set
+        'nproc' greater than one to share the blocks among a pool of that
+        many processes, which each open the file and its saved map and
+        write their pings straight into the output files.  Progress and the
+        number of pings resolved per second are printed unless 'verbose' is
+        False.  On Windows this must be called from under an
+        "if __name__ == '__main__'" guard.
+        """
+        if ssp_filename is not None:
+            self.ssp_filename = ssp_filename
+            self.have_ssp_file = True
+        if not self.have_patchtest:
+            self.set_patch_test_values()
+        numbeams = self._beam_counts()
+        numpings = len(numbeams)
+        if numpings == 0:
+            print 'no pings to resolve.'
+            return None
+        if outname is None:
+            outname = os.path.splitext(self.p.infilename)[0]
+        outnames = [outname + '_' + name + '.npy' for name in ['time', 'x', 'y', 'depth']]
+        outputs = []
+        for name in outnames:
+            out = np.lib.format.open_memmap(name, mode = 'w+', dtype = np.float64,
+                shape = (numpings, numbeams.max()))
+            out[:] = np.nan
+            out.flush()
+            outputs.append(out)
+        blocks = [(first, min(first + blocksize, numpings))
+            for first in range(0, numpings, blocksize)]
+        starttime = time.time()
+        if nproc > 1 and len(blocks) > 1:
+            settings = {'filename':self.p.infilename, 'outnames':outnames,
+                'ssp_filename':getattr(self, 'ssp_filename', None),
+                'have_ssp_file':self.have_ssp_file, 'apply_heading':self.apply_heading,
+                'apply_xducer_depth':self.apply_xducer_depth,
+                'patchtest':(self.roll_offset, self.pitch_offset, self.heading_offset,
+                self.position_delay, self.attitude_delay)}
+            pool = multiprocessing.Pool(nproc, _resolve_init, (settings,))
+            results = pool.imap_unordered(_resolve_block, blocks)
+        else:
+            pool = None
+            results = (self._write_block(first, last, outputs) for first, last in blocks)
+        done = 0
+        reported = 0
+        for count in results:
+            done += count
+            if verbose and (done * 10 // numpings > reported or done == numpings):
+                reported = done * 10 // numpings
+                elapsed = max(time.time() - starttime, 1e-6)
+                print 'resolved ' + str(done) + ' of ' + str(numpings) + ' pings, ' + \
+                    '%.1f' % (done / elapsed) + ' pings/s'
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for out in outputs:
+            out.flush()
+        return tuple(outputs)
+        
+    def _beam_counts(self):
+        """
+        Returns the number of receive beams in each range and angle record,
+        read from the record headers without decoding the records.
+        """
+        if self.p.map.packdir.has_key('78'):
+            recordtype, dtype = '78', Data78.hdr_file_dtype[self.p.byteswap]
+        elif self.p.map.packdir.has_key('102'):
+            recordtype, dtype = '102', Data102.hdr_file_dtype[self.p.byteswap]
+        else:
+            return np.zeros(0, dtype = np.int64)
+        locs = self.p.map.packdir[recordtype][:,0].astype(np.int64)
+        offset = Datagram.hdr_dtype.itemsize + dtype.fields['Nrx'][1]
+        mm, buf = self.p._open_buffer()
+        counts = self.p._gather_uint(buf, locs + offset, 2).astype(np.int64)
+        del buf
+        self.p._close_buffer(mm)
+        return counts
+        
+    def _write_block(self, first, last, outputs):
         """
-        still working this out.
+        Resolves pings first through last - 1 and writes them into rows of
+        the time, x, y and depth output arrays.  Returns the number of
+        pings written.
         """
-        self.ssp_filename = ssp_filename
-        numpings = len(self.p.map.packdir['78'])
-        for ping in range(numpings):
-            self.resolve_ping(ping)
+        for n, result in enumerate(self.resolve_block(range(first, last))):
+            for out, values in zip(outputs, result):
+                out[first + n,:len(values)] = values
+        return last - first
         
-    def resolve_ping(self, recordnum, ssp_filename = None):
+    def resolve_block(self, recordnums, verbose = False):
+        """
+        Resolves each of a block of pings as resolve_ping does, finding the
+        beam angles of all of the pings together, and returns a list of the
+        time, x, y and depth arrays of each ping.
+        """
+        if not self.have_patchtest:
+            self.set_patch_test_values()
+        pings = []
+        for recordnum in recordnums:
+            self.get_supporting_data(recordnum)
+            pings.append((self.tstamp, self.header, self.tx, self.rx))
+        results = []
+        for ping, angles in zip(pings, self._angle_bearing(pings, verbose)):
+            tstamp, rxnav, twtt, azimuth, beam_depression, heave = angles
+            surface_ss = ping[1]['SoundSpeed']
+            x, y, depth = self._resolve_beams(tstamp, rxnav, twtt, azimuth,
+                beam_depression, surface_ss)
+            results.append((tstamp, x, y, depth))
+        return results
+        
+    def resolve_ping(self, recordnum, ssp_filename = None, verbose = True):
         """
         First hack at resolving a depth... not sure how this is going to work.
         Figuring it out as I go.  Need to add a better way for checking to see
-        if a file is loaded, replacing a file, etc.
+        if a file is loaded, replacing a file, etc.  Set 'verbose' to False
+        to not print the beam working.
         """
         # set the ssp filename
         if ssp_filename is not None:
@@ -1558,13 +3448,23 @@ class resolve_file_depths:
             self.set_patch_test_values()
             
         self.get_supporting_data(recordnum)
-        tstamp, rxnav, twtt, azimuth, beam_depression, heave = self.get_ping_angle_bearing(recordnum)
+        tstamp, rxnav, twtt, azimuth, beam_depression, heave = \
+            self.get_ping_angle_bearing(recordnum, verbose)
+        x, y, depth = self._resolve_beams(tstamp, rxnav, twtt, azimuth,
+            beam_depression, self.surface_ss)
+        return tstamp, x, y, depth
+        
+    def _resolve_beams(self, tstamp, rxnav, twtt, azimuth, beam_depression, surface_ss):
+        """
+        Ray traces the beams of a ping from their angles and returns the x,
+        y and depth of each.
+        """
         #get which side the pings are on
         swathside = np.sign(beam_depression)
         # get cast for the first sounding in the ping
         casttime = dtm.datetime.utcfromtimestamp(tstamp[0])
         # h_range is from the transducer.
-        h_range, depth = self.raytrace(twtt, beam_depression, self.xducer_depth, self.surface_ss, casttime)
+        h_range, depth = self.raytrace(twtt, beam_depression, self.xducer_depth, surface_ss, casttime)
         h_range *= swathside
         # return the depth measurement to being referenced to the transducer.
         if not self.apply_xducer_depth:
@@ -1581,7 +3481,7 @@ class resolve_file_depths:
             x += self.txoffset[0]
             y += self.txoffset[1]
         
-        return tstamp, x, y, depth
+        return x, y, depth
     
     def get_supporting_data(self, recordnum):
         """
@@ -1613,10 +3513,35 @@ class resolve_file_depths:
         self.rx = self.p.packet.subpack.rx
         self.surface_ss = self.header['SoundSpeed']
     
-    def get_ping_angle_bearing(self, recordnum):
+    def get_ping_angle_bearing(self, recordnum, verbose = True):
+        """
+        Do all the rotation stuff for the ping read by get_supporting_data.
+        All beams of the ping are worked together as stacked arrays.  Set
+        'verbose' to False to not print the working for the first beam.
+        """
+        ping = (self.tstamp, self.header, self.tx, self.rx)
+        return self._angle_bearing([ping], verbose)[0]
+        
+    def get_block_angle_bearing(self, recordnums, verbose = False):
+        """
+        Returns the get_ping_angle_bearing results for each of a block of
+        pings in a list, working the beams of all of the pings together.
+        The supporting data is left as that of the last ping.
+        """
+        pings = []
+        for recordnum in recordnums:
+            self.get_supporting_data(recordnum)
+            pings.append((self.tstamp, self.header, self.tx, self.rx))
+        return self._angle_bearing(pings, verbose)
+        
+    def _angle_bearing(self, pings, verbose = False):
+        """
+        Finds the beam depression angle and azimuth of every beam of the
+        given pings, each a tuple of the ping time stamp and its header, tx
+        and rx arrays.  The navigation for all transmit and receive times is
+        found in one call each, and the beam vectors are made from stacked
+        rotation matrices.
         """
-        Do all the rotation stuff.
-        """        
         # TX is reverse mounted: subtract 180 from heading installation angle,
         # and flip sign of the pitch offset.
         # RX is reverse mounted: subtract 180 from heading installation angle,
@@ -1630,99 +3555,59 @@ class resolve_file_depths:
             rxo = -1
         else: rxo = 1
         
-        tx_vector = txo * np.mat([1,0,0]).T
-        rx_vector = rxo * np.mat([0,1,0]).T
-
-        txnum = self.tx['TransmitSector#'].argsort()  # this is getting the transmit # order
-        
-        # form array of transmit times
-        if self.header['Ntx'] > 1:
-            txtimes = []
-            for indx in txnum:
-                txtimes.append(self.tstamp + self.tx['Delay'][indx])
-        else:
-            txtimes = [self.tstamp + self.tx['Delay'][0]]
-        txnav = self.p.getnav(txtimes)  # this is in tx sector order
-
-        # make a TX rotation matrix for each sector in the "ping"
-        TX = []
-        # the alignment matrix
-        TXa = self.rot_mat(self.txrot[0], self.txrot[1], self.txrot[2])
-        for entry in txnav:
-            # the orientation matrix for each sector
-            TXo = self.rot_mat(entry[3],entry[4],entry[6])
-            TX.append(TXo * TXa * tx_vector)
-        # get receive times to get navigation information
-        rxtimes = np.zeros(len(self.rx))
-        if self.p.map.packdir.has_key('78'):
-            twowaytraveltimes = self.rx['TravelTime']
-        else:
-            twowaytraveltimes = self.rx['Range']/ self.header['SamplingFrequency']
-        for i, txtime in enumerate(txtimes):
-            # this gets the index of all rx beams belonging to a particular tx
-            rxnums = np.nonzero(self.rx['TransmitSectorID'] == i)[0]
-            # then it adds the tx offset to that particular group of rx
-            rxtimes[rxnums] = twowaytraveltimes[rxnums].astype(np.float64) + txtime
-        
-        # find the beam pointing vector for each beam
-        beam_depression = np.zeros(len(self.rx))
-        azimuth = np.zeros(len(self.rx))
-        
-        # the rx alignment matrix
-        RXa = self.rot_mat(self.rxrot[0], self.rxrot[1], self.rxrot[2])
-        # get the nav for all rx times in this ping
+        txtimes, txsteer, rxtimes, rxsteer, sectors, traveltimes = [], [], [], [], [], []
+        numtx = 0
+        for tstamp, header, tx, rx in pings:
+            # transmit times and steering in transmit sector order
+            txnum = tx['TransmitSector#'].argsort()
+            pingtxtimes = tstamp + tx['Delay'][txnum].astype(np.float64)
+            if self.p.map.packdir.has_key('78'):
+                twowaytraveltimes = rx['TravelTime']
+            else:
+                twowaytraveltimes = rx['Range']/ header['SamplingFrequency']
+            # the receive time of each beam is from the time of its tx sector
+            sector = rx['TransmitSectorID'].astype(np.int64)
+            insector = sector < len(pingtxtimes)
+            pingrxtimes = np.zeros(len(rx))
+            pingrxtimes[insector] = twowaytraveltimes[insector].astype(np.float64) + \
+                pingtxtimes[sector[insector]]
+            txtimes.append(pingtxtimes)
+            txsteer.append(np.deg2rad(tx['TiltAngle'][txnum].astype(np.float64)) * txo)
+            rxtimes.append(pingrxtimes)
+            rxsteer.append(np.deg2rad(rx['BeamPointingAngle'].astype(np.float64)) * rxo)
+            sectors.append(sector + numtx)
+            traveltimes.append(twowaytraveltimes)
+            numtx += len(pingtxtimes)
+        txtimes = np.concatenate(txtimes)
+        rxtimes = np.concatenate(rxtimes)
+        sector = np.concatenate(sectors)
+        
+        # transmit and receive array pointing vectors, each row turned by the
+        # orientation at its transmit or receive time
+        txnav = self.p.getnav(txtimes)
         rxnav = self.p.getnav(rxtimes)
-        heave = np.zeros(len(self.rx))
-        for i, entry in enumerate(rxnav):
-            # the orientation matrix for each receive beam
-            RXo = self.rot_mat(entry[3] + self.roll_offset, 
-                entry[4]+self.pitch_offset, entry[6]+self.heading_offset)
-            RX = RXo * RXa * rx_vector
-            tx_indx = int(self.rx['TransmitSectorID'][i])  # get the tx number
-            heave[i] = (rxnav[i][-2] + txnav[tx_indx][-2])/2
-            # this section of code is in radians
-            rx_steer = np.deg2rad(self.rx['BeamPointingAngle'][i]) * rxo
-            tx_steer = np.deg2rad(self.tx['TiltAngle'][txnum[tx_indx]]) * txo
-            misalign = np.arccos(TX[tx_indx].T * RX) - pi/2
-            x = sin(tx_steer)
-            y1 = -sin(rx_steer) / cos(misalign)
-            y2 = x * np.tan(misalign)
-            y = y1 + y2
-            z = np.sqrt(1 - x**2 - y**2)
-            BVp = np.array([x,y,z])
-            Xp = TX[tx_indx].T
-            Zp = np.cross(Xp,RX.T)
-            Yp = np.cross(Zp,Xp)
-            Rgeo = np.array([Xp,Yp,Zp]).T
-            BV = np.dot(Rgeo,BVp.T)
-            beam_depression[i] = np.arctan2(BV[2],np.sqrt(BV[0]**2 + BV[1]**2))
-            azimuth[i] = np.arctan2(BV[1],BV[0])
-            # end radians section of code
-            if i == 0:
-                print 'TX, RX'
-                print TX[tx_indx]
-                print RX
-                print 'txsteer, rxsteer, misalign'
-                print np.rad2deg([tx_steer, rx_steer])
-                print misalign
-                print 'heave, draft of xducer'
-                print txnav[tx_indx][-2]
-                print str(self.xducer_depth + heave[i])
-                print 'x,y1,y2,y,z'
-                print x, y1, y2, y, z
-                print 'Xp,Yp,Zp'
-                print Xp
-                print Yp
-                print Zp
-                print 'BVp, Rgeo, BV'
-                print BVp
-                print Rgeo
-                print BV
-                print 'beam depression 0, azimuth 0'
-                print np.rad2deg(beam_depression[0])
-                print np.rad2deg(azimuth[0])
-                
-           
+        TX = self.sensor_vectors(txnav, self.txrot, [txo, 0, 0])
+        RX = self.sensor_vectors(rxnav, self.rxrot, [0, rxo, 0], (self.roll_offset,
+            self.pitch_offset, self.heading_offset))
+        Xp = TX[sector]
+        heave = (rxnav[:,-2] + txnav[sector,-2])/2
+        # this section of code is in radians
+        rx_steer = np.concatenate(rxsteer)
+        tx_steer = np.concatenate(txsteer)[sector]
+        misalign = np.arccos((Xp * RX).sum(axis = 1)) - pi/2
+        x = sin(tx_steer)
+        y1 = -sin(rx_steer) / cos(misalign)
+        y2 = x * np.tan(misalign)
+        y = y1 + y2
+        z = np.sqrt(1 - x**2 - y**2)
+        # the beam vector in the frame of the tx and rx arrays
+        Zp = np.cross(Xp, RX)
+        Yp = np.cross(Zp, Xp)
+        BV = Xp * x[:,np.newaxis] + Yp * y[:,np.newaxis] + Zp * z[:,np.newaxis]
+        beam_depression = np.arctan2(BV[:,2], np.sqrt(BV[:,0]**2 + BV[:,1]**2))
+        azimuth = np.arctan2(BV[:,1], BV[:,0])
+        # end radians section of code
+        
         beam_depression = np.rad2deg(beam_depression)
         azimuth = np.rad2deg(azimuth)
         if not self.apply_heading:
@@ -1732,36 +3617,105 @@ class resolve_file_depths:
         lessthanzero = np.nonzero(azimuth < 0)[0]
         azimuth[lessthanzero] += 360
         
-        return rxtimes, rxnav, twowaytraveltimes, azimuth, beam_depression, heave
+        results = []
+        first = 0
+        for twowaytraveltimes in traveltimes:
+            last = first + len(twowaytraveltimes)
+            if verbose and last > first:
+                i = first
+                print 'TX, RX'
+                print Xp[i]
+                print RX[i]
+                print 'txsteer, rxsteer, misalign'
+                print np.rad2deg([tx_steer[i], rx_steer[i]])
+                print misalign[i]
+                print 'heave, draft of xducer'
+                print txnav[sector[i]][-2]
+                print str(self.xducer_depth + heave[i])
+                print 'x,y1,y2,y,z'
+                print x[i], y1[i], y2[i], y[i], z[i]
+                print 'Xp,Yp,Zp'
+                print Xp[i]
+                print Yp[i]
+                print Zp[i]
+                print 'BV'
+                print BV[i]
+                print 'beam depression 0, azimuth 0'
+                print beam_depression[i]
+                print np.rad2deg(np.arctan2(BV[i,1], BV[i,0]))
+            results.append((rxtimes[first:last], rxnav[first:last], twowaytraveltimes,
+                azimuth[first:last], beam_depression[first:last], heave[first:last]))
+            first = last
+        return results
     
     def rot_mat(self, theta, phi, gamma, degrees = True):
         """
-        Make the rotation matrix for a set of angles and return the matrix.
-        All file angles are in degrees, so incoming angles are degrees.
+        Make the rotation matrix for a set of angles and return the matrix
+        as a (3, 3) array.  All file angles are in degrees, so incoming
+        angles are degrees.
+        """
+        return self.rot_mats(theta, phi, gamma, degrees)[0]
+        
+    def rot_mats(self, theta, phi, gamma, degrees = True):
+        """
+        Makes the rotation matrix for each of the roll (theta), pitch (phi)
+        and heading (gamma) angles in the given arrays, or single values,
+        and returns them stacked in an (N, 3, 3) array.
         """
+        t, p, g = [np.atleast_1d(a).astype(np.float64) for a in (theta, phi, gamma)]
         if degrees == True:
-            t,p,g = np.deg2rad([theta,phi,gamma])
-        else:
-            t,p,g = theta, phi, gamma
-        rmat = np.mat(
-            [[cos(p)*cos(g), sin(t)*sin(p)*cos(g) - cos(t)*sin(g), cos(t)*sin(p)*cos(g) + sin(p)*sin(g)],
-            [cos(p)*sin(g), sin(t)*sin(p)*sin(g) + cos(t)*cos(g), cos(t)*sin(p)*sin(g) - sin(t)*cos(g)],
-            [-sin(p), sin(t)*cos(p), cos(t)*cos(p)]]
-            )
+            t, p, g = np.deg2rad(t), np.deg2rad(p), np.deg2rad(g)
+        st, ct, sp, cp, sg, cg = sin(t), cos(t), sin(p), cos(p), sin(g), cos(g)
+        rmat = np.empty((len(t), 3, 3))
+        rmat[:,0,0] = cp*cg
+        rmat[:,0,1] = st*sp*cg - ct*sg
+        rmat[:,0,2] = ct*sp*cg + sp*sg
+        rmat[:,1,0] = cp*sg
+        rmat[:,1,1] = st*sp*sg + ct*cg
+        rmat[:,1,2] = ct*sp*sg - st*cg
+        rmat[:,2,0] = -sp
+        rmat[:,2,1] = st*cp
+        rmat[:,2,2] = ct*cp
         return rmat
         
+    def compose_rot_mats(self, orientation, alignment):
+        """
+        Returns the products orientation x alignment of (N, 3, 3) or (3, 3)
+        rotation matrices, such as the attitude of the vessel at each of N
+        times with the fixed installation angles of a sensor.
+        """
+        return np.matmul(orientation, alignment)
+        
+    def rotate_vectors(self, rmats, vectors):
+        """
+        Returns the (N, 3) array of each vector turned by its rotation
+        matrix.  Either may be a single matrix or vector.
+        """
+        return np.einsum('...ij,...j->...i', rmats, vectors)
+        
+    def sensor_vectors(self, nav, alignment, vector, offsets = (0, 0, 0)):
+        """
+        Returns the (N, 3) array of the sensor axis 'vector' turned by the
+        installation angles (roll, pitch, heading) in 'alignment' and by the
+        attitude in each row of the getnav array 'nav', with the patch test
+        angle 'offsets' added to the attitude.
+        """
+        Ra = self.rot_mats(*alignment)
+        Ro = self.rot_mats(nav[:,3] + offsets[0], nav[:,4] + offsets[1],
+            nav[:,6] + offsets[2])
+        return self.rotate_vectors(self.compose_rot_mats(Ro, Ra), vector)
+        
     def raytrace(self, twowaytraveltimes, beam_depression, xducer_depth, surface_ss, casttime):
         """
         Calls Jonny B's SV class to do the ray trace if possible, otherwise just assumes
-        surface_ss for whole water column.  Need to make this so it does not load a new file
-        if the file name is the same.  This might also require updates to JB's code...
+        surface_ss for whole water column.  The profile used is taken from
+        the cast cache, see get_cast.
         """
         
         if have_svp_module and self.have_ssp_file:
             y = np.zeros(len(beam_depression))
             z = np.zeros(len(beam_depression))
-            profile = svp.SV()
-            profile.read_hips(self.ssp_filename, time = casttime)
+            profile = self.get_cast(self.ssp_filename, casttime)
             indx = 0
             for twtt,angle in zip(twowaytraveltimes,beam_depression):
                 if not np.isnan(angle):
@@ -1769,11 +3723,72 @@ class resolve_file_depths:
                     indx +=1
 
         else:
-            print 'Unable to use Jonny B svp module.  Assuming surface sound speed throughout watercolumn!'
+            if not self.__dict__.has_key('svp_warned'):
+                # once per file rather than for every ping
+                print 'Unable to use Jonny B svp module.  Assuming surface sound speed throughout watercolumn!'
+                self.svp_warned = True
             y = surface_ss/2 * twowaytraveltimes * cos(np.deg2rad(beam_depression))
             z = xducer_depth + surface_ss/2 * twowaytraveltimes * sin(np.deg2rad(beam_depression))
             
         return y, z
+        
+    def get_cast(self, ssp_filename, casttime):
+        """
+        Returns the svp.SV profile for the cast in the HIPS file to use at
+        the datetime 'casttime'.  The cast is chosen here as the one nearest
+        in time, and is read by passing its own time to read_hips, so the
+        choice no longer rests with read_hips and may differ from it where
+        read_hips would take the previous cast.  Parsed casts are kept in
+        the recordcache 'casts' keyed by file name and cast number, holding
+        up to 'maxcasts' casts, so pings using the same cast do not read the
+        file again.  One SV object serves every ping using its cast, which
+        assumes that SV.raytrace keeps no state between calls.  If the cast
+        times cannot be found in the file the cast is kept for its time
+        only, and read_hips chooses the cast.
+        """
+        times = self.get_cast_times(ssp_filename)
+        tstamp = (casttime - dtm.datetime(1970, 1, 1)).total_seconds()
+        if len(times) > 0:
+            after = min(np.searchsorted(times, tstamp), len(times) - 1)
+            before = max(after - 1, 0)
+            if abs(times[before] - tstamp) <= abs(times[after] - tstamp):
+                castnum = before
+            else:
+                castnum = after
+            key = (ssp_filename, castnum)
+            casttime = dtm.datetime.utcfromtimestamp(times[castnum])
+        else:
+            key = (ssp_filename, tstamp)
+        profile = self.casts.get(key)
+        if profile is None:
+            profile = svp.SV()
+            profile.read_hips(ssp_filename, time = casttime)
+            self.casts.put(key, profile, 1)
+        return profile
+        
+    def get_cast_times(self, ssp_filename):
+        """
+        Returns the sorted POSIX times of the casts in a HIPS sound speed
+        file, read from the 'Section yyyy-ddd hh:mm:ss' line starting each
+        cast.  The times are kept until the file is changed.
+        """
+        mtime = os.path.getmtime(ssp_filename)
+        if self.cast_index.has_key(ssp_filename) and self.cast_index[ssp_filename][0] == mtime:
+            return self.cast_index[ssp_filename][1]
+        times = []
+        for line in open(ssp_filename):
+            fields = line.split()
+            if len(fields) >= 3 and fields[0] == 'Section':
+                for timeformat in ['%Y-%j %H:%M:%S', '%Y-%j %H:%M']:
+                    try:
+                        day = dtm.datetime.strptime(fields[1] + ' ' + fields[2], timeformat)
+                    except ValueError:
+                        continue
+                    times.append((day - dtm.datetime(1970, 1, 1)).total_seconds())
+                    break
+        times = np.sort(times)
+        self.cast_index[ssp_filename] = (mtime, times)
+        return times
             
     def compare_to_xyz(self, recordnum, svfile = None):
         """
@@ -1834,4 +3849,4 @@ def main():
         print "No filename provided."
         
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
\ No newline at end of file
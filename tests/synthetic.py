@@ -0,0 +1,138 @@
+"""
+synthetic.py
+
+Writes small Kongsberg .all files for the tests, holding installation,
+sound speed profile, attitude, network attitude, surface sound speed,
+position, range and angle, XYZ and water column datagrams.
+"""
+
+import struct
+import numpy as np
+
+DATE = 20130701
+# the POSIX time of the DATE midnight
+EPOCH = 1372636800
+
+
+def datagram(dtype, ms, body, endian = '<', date = DATE):
+    """Returns the datagram with its length, header, ETX and checksum."""
+    hdr = struct.pack(endian + 'BBHII', 2, dtype, 2040, date, ms)
+    checksum = sum(bytearray(hdr[2:] + body)) & 0xffff
+    rest = hdr + body + struct.pack(endian + 'BH', 3, checksum)
+    return struct.pack(endian + 'I', len(rest)) + rest
+
+
+def installation(ms, e):
+    text = 'WLZ=-0.5,S1X=1.2,S1Y=0.3,S1Z=2.1,S1R=0.1,S1P=-0.2,S1H=180.5,' \
+        'S2X=1.0,S2Y=0.5,S2Z=2.2,S2R=0.05,S2P=0.1,S2H=0.3,'
+    return datagram(73, ms, struct.pack(e + 'HHH', 1, 100, 0) + text, e)
+
+
+def soundspeed_profile(ms, e):
+    body = struct.pack(e + 'HHIIHH', 1, 100, DATE, ms, 3, 1)
+    for depth, speed in ((0, 15000), (1000, 14900), (5000, 14800)):
+        body += struct.pack(e + 'II', depth, speed)
+    return datagram(85, ms, body + '\x00', e)
+
+
+def position(ms, n, e, lat0 = 41.0, lon0 = -70.0):
+    lat = int(round((lat0 + n * 1e-5) * 2e7))
+    lon = int(round((lon0 + n * 2e-5) * 1e7))
+    body = struct.pack(e + 'HHiiHHHHBB', n, 100, lat, lon, 50, 300, 4500, 4490, 1, 5)
+    return datagram(80, ms, body + 'GPGGA', e)
+
+
+def attitude(ms, n, rng, e, numentries = 20):
+    body = struct.pack(e + 'HHH', n, 100, numentries)
+    for k in range(numentries):
+        body += struct.pack(e + 'HHhhhH', k * 50, 0, int(rng.randint(-500, 500)),
+            int(rng.randint(-300, 300)), int(rng.randint(-100, 100)),
+            (35900 + k * 20) % 36000)
+    return datagram(65, ms, body + '\x07', e)
+
+
+def network_attitude(ms, n, rng, e, numentries = 20):
+    body = struct.pack(e + 'HHHBB', n, 100, numentries, 1, 0)
+    for k in range(numentries):
+        # most sensors give input of one size, so vary it in odd datagrams only
+        if n % 2 == 0:
+            numbytes = 4
+        else:
+            numbytes = int(rng.randint(0, 6))
+        body += struct.pack(e + 'HhhhHB', k * 50, int(rng.randint(-500, 500)),
+            int(rng.randint(-300, 300)), int(rng.randint(-100, 100)),
+            (35900 + k * 30) % 36000, numbytes) + 'x' * numbytes
+    return datagram(110, ms, body + '\x00', e)
+
+
+def surface_soundspeed(ms, n, rng, e):
+    body = struct.pack(e + 'HHH', n, 100, 1)
+    body += struct.pack(e + 'HH', 0, 15000 + int(rng.randint(0, 300)))
+    return datagram(71, ms, body + '\x00', e)
+
+
+def range_angle(ms, n, e, numbeams = 32, numtx = 2):
+    body = struct.pack(e + 'HHHHHHfI', n, 100, 15000, numtx, numbeams, numbeams, 15000., 0)
+    for t in range(numtx):
+        body += struct.pack(e + 'hHfffHBBf', -100 + 200 * t, 0, 0.0002, 0.001 * t,
+            300000., 5000, 0, t, 1000.)
+    for b in range(numbeams):
+        body += struct.pack(e + 'hBBHBbfhbB', int(6500 - b * 13000 / numbeams),
+            b * numtx // numbeams, 0, 10, 50, 0, 0.02 + 0.0001 * abs(b - numbeams / 2),
+            -250, 0, 0)
+    return datagram(78, ms, body + '\x00', e)
+
+
+def xyz(ms, n, e, numbeams = 32):
+    body = struct.pack(e + 'HHHHfHHfi', n, 100, 4500, 15000, 2.1, numbeams, numbeams, 15000., 0)
+    for b in range(numbeams):
+        body += struct.pack(e + 'fffHBbBbh', 20. + b * 0.1, -30. + b, 0.5, 10, 50, 3, 0, 0, -250)
+    return datagram(88, ms, body + '\x00', e)
+
+
+def watercolumn(ms, n, rng, e, numbeams = 32, numdatagrams = 2, maxsamples = 40):
+    out = []
+    perdatagram = numbeams // numdatagrams
+    for d in range(numdatagrams):
+        body = struct.pack(e + 'HHHHHHHHIhBbB3B', n, 100, numdatagrams, d + 1, 1, numbeams,
+            perdatagram, 15000, 1500000, 10, 30, 0, 0, 0, 0, 0)
+        body += struct.pack(e + 'hHBB', 0, 30000, 0, 0)
+        for b in range(perdatagram):
+            numsamples = int(rng.randint(maxsamples // 2, maxsamples))
+            beam = d * perdatagram + b
+            body += struct.pack(e + 'hHHHBB', 6500 - beam * 30, 0, numsamples,
+                numsamples - 5, 0, beam % 256)
+            body += rng.randint(-128, 127, numsamples).astype('b').tostring()
+        out.append(datagram(107, ms, body + '\x00', e))
+    return ''.join(out)
+
+
+def write(filename, seconds = 10, start = 3600, e = '<', append = False, seed = 0):
+    """
+    Writes (or with 'append' adds to) an .all file of 'seconds' seconds of
+    data starting 'start' seconds after midnight of DATE, with two pings
+    and two positions each second.  'e' is '<' or '>' for the byte order.
+    """
+    rng = np.random.RandomState(seed)
+    if append:
+        outfile = open(filename, 'ab')
+    else:
+        outfile = open(filename, 'wb')
+    t0 = start * 1000
+    outfile.write(installation(t0, e))
+    outfile.write(soundspeed_profile(t0, e))
+    ping = start * 2
+    for s in range(seconds):
+        ms = t0 + s * 1000
+        outfile.write(attitude(ms, s, rng, e))
+        outfile.write(network_attitude(ms + 1, s, rng, e))
+        outfile.write(surface_soundspeed(ms + 2, s, rng, e))
+        for k in range(2):
+            outfile.write(position(ms + 500 * k + 3, (start + s) * 2 + k, e))
+        for k in range(2):
+            pms = ms + 100 + 400 * k
+            outfile.write(range_angle(pms, ping, e))
+            outfile.write(xyz(pms, ping, e))
+            outfile.write(watercolumn(pms, ping, rng, e))
+            ping += 1
+    outfile.close()
@@ -0,0 +1,209 @@
+"""
+Tests of the binary file index made by allRead.savefilemap.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import par
+import synthetic
+
+
+class IndexTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'test.all')
+        synthetic.write(self.filename)
+        
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        
+    def test_round_trip(self):
+        mapped = par.allRead(self.filename)
+        mapped.mapfile()
+        mapped.savefilemap()
+        loaded = par.allRead(self.filename)
+        loaded.loadfilemap()
+        self.assertFalse(loaded.map.is_stale(loaded.filelen, loaded.filemtime))
+        self.assertEqual(sorted(loaded.map.packdir.keys()), sorted(mapped.map.packdir.keys()))
+        for key in mapped.map.packdir.keys():
+            np.testing.assert_array_equal(loaded.map.packdir[key], mapped.map.packdir[key])
+        np.testing.assert_array_equal(loaded.map.getpings(), mapped.map.getpings())
+        self.assertEqual(loaded.mapped_to, mapped.mapped_to)
+        mapped.close()
+        loaded.close()
+        
+    def test_views_kept_across_save(self):
+        reader = par.allRead(self.filename)
+        reader.mapfile()
+        reader.savefilemap()
+        reader = par.allRead(self.filename)
+        reader.loadfilemap()
+        times = reader.map.gettimes(80)
+        positions = reader.map.packdir['80']
+        expected = np.array(times)
+        reader.savefilemap()
+        reader.map.close()
+        np.testing.assert_array_equal(times, expected)
+        np.testing.assert_array_equal(positions[:,1], expected)
+        reader.close()
+        
+    def test_update_map_matches_mapfile(self):
+        reader = par.allRead(self.filename)
+        reader.mapfile()
+        reader.build_navarray()
+        synthetic.write(self.filename, start = 3610, append = True, seed = 1)
+        self.assertTrue(reader.update_map() > 0)
+        full = par.allRead(self.filename)
+        full.mapfile()
+        full.build_navarray()
+        self.assertEqual(sorted(reader.map.packdir.keys()), sorted(full.map.packdir.keys()))
+        for key in full.map.packdir.keys():
+            np.testing.assert_array_equal(reader.map.packdir[key], full.map.packdir[key])
+        np.testing.assert_array_equal(reader.map.getpings(), full.map.getpings())
+        self.assertEqual(reader.mapped_to, full.mapped_to)
+        for key in full.navarray.keys():
+            np.testing.assert_array_equal(reader.navarray[key], full.navarray[key])
+        reader.close()
+        full.close()
+        
+    def check_update_after_rewrite(self, use_mmap, **kwargs):
+        reader = par.allRead(self.filename, use_mmap = use_mmap)
+        reader.mapfile()
+        reader.build_navarray()
+        stat = os.stat(self.filename)
+        synthetic.write(self.filename, **kwargs)
+        os.utime(self.filename, (stat.st_atime, stat.st_mtime + 10))
+        self.assertTrue(reader.update_map() > 0)
+        full = par.allRead(self.filename)
+        full.mapfile()
+        full.build_navarray()
+        self.assertEqual(sorted(reader.map.packdir.keys()), sorted(full.map.packdir.keys()))
+        for key in full.map.packdir.keys():
+            np.testing.assert_array_equal(reader.map.packdir[key], full.map.packdir[key])
+        for key in full.navarray.keys():
+            np.testing.assert_array_equal(reader.navarray[key], full.navarray[key])
+        reader.getrecord(80, 0)
+        full.getrecord(80, 0)
+        self.assertEqual(reader.packet.time, full.packet.time)
+        self.assertEqual(reader.update_map(), 0)
+        reader.close()
+        full.close()
+        
+    def test_update_map_truncated(self):
+        for use_mmap in [False, True]:
+            synthetic.write(self.filename)
+            self.check_update_after_rewrite(use_mmap, seconds = 4, start = 3700)
+            
+    def test_update_map_rewritten_same_size(self):
+        for use_mmap in [False, True]:
+            synthetic.write(self.filename)
+            size = os.path.getsize(self.filename)
+            self.check_update_after_rewrite(use_mmap, start = 3700)
+            self.assertEqual(os.path.getsize(self.filename), size)
+            
+    def test_navarray_kept_across_save(self):
+        reader = par.allRead(self.filename)
+        reader.mapfile()
+        reader.build_navarray()
+        reader.savefilemap()
+        reader = par.allRead(self.filename)
+        reader.loadfilemap()
+        reader.build_navarray()
+        times = reader.map.gettimes(78)
+        expected = reader.getnav(times)
+        reader.build_geoindex(78)
+        reader.savefilemap()
+        reader.map.close()
+        np.testing.assert_array_equal(reader.getnav(times), expected)
+        reader.close()
+        
+    def block_index(self):
+        """
+        Makes the index file unwritable, as in a read only directory, by
+        putting a directory where its temporary file would be written.
+        """
+        os.mkdir(os.path.join(self.tempdir, 'test.par.tmp'))
+        
+    def test_stale_index_read_only(self):
+        reader = par.allRead(self.filename)
+        reader.mapfile()
+        reader.savefilemap()
+        reader.close()
+        synthetic.write(self.filename, start = 3610, append = True, seed = 1)
+        self.block_index()
+        reader = par.allRead(self.filename)
+        reader.loadfilemap()
+        self.assertTrue(reader.mapped)
+        full = par.allRead(self.filename)
+        full.mapfile()
+        for key in full.map.packdir.keys():
+            np.testing.assert_array_equal(reader.map.packdir[key], full.map.packdir[key])
+        reader.close()
+        full.close()
+        
+    def test_navarray_read_only(self):
+        reader = par.allRead(self.filename)
+        reader.mapfile()
+        reader.savefilemap()
+        reader.close()
+        self.block_index()
+        reader = par.allRead(self.filename)
+        reader.loadfilemap()
+        times = reader.map.gettimes(78)
+        nav = reader.getnav(times)
+        self.assertTrue(reader.navarray.has_key('80'))
+        full = par.allRead(self.filename)
+        full.mapfile()
+        np.testing.assert_array_equal(nav, full.getnav(times))
+        reader.close()
+        full.close()
+        
+    def test_getrecords_in_box_saves_once(self):
+        reader = par.allRead(self.filename)
+        reader.mapfile()
+        reader.savefilemap()
+        reader.close()
+        saved = []
+        save = par.allRead.savefilemap
+        def counting_save(reader, mapfilename = ''):
+            saved.append(mapfilename)
+            save(reader, mapfilename)
+        par.allRead.savefilemap = counting_save
+        try:
+            reader = par.allRead(self.filename)
+            reader.loadfilemap()
+            found = reader.getrecords_in_box(78, 40, 42, -71, -69)
+        finally:
+            par.allRead.savefilemap = save
+        self.assertEqual(len(saved), 1)
+        self.assertEqual(len(found), len(reader.map.packdir['78']))
+        reader.close()
+        reader = par.allRead(self.filename)
+        reader.loadfilemap()
+        self.assertTrue(reader.map.aux.has_key('geo78'))
+        self.assertTrue(reader.map.aux.has_key('nav80'))
+        reader.close()
+        
+    def test_getrecords_in_box_read_only(self):
+        reader = par.allRead(self.filename)
+        reader.mapfile()
+        reader.savefilemap()
+        reader.close()
+        self.block_index()
+        reader = par.allRead(self.filename)
+        reader.loadfilemap()
+        found = reader.getrecords_in_box(78, 40, 42, -71, -69)
+        self.assertEqual(len(found), len(reader.map.packdir['78']))
+        reader.close()
+        
+        
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+"""
+Tests that records decode the same whichever way the file is read.
+"""
+
+import os
+import sys
+import struct
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import par
+import synthetic
+
+
+class RecordTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'test.all')
+        synthetic.write(self.filename)
+        
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        
+    def assertSameRecord(self, a, b, ignore = ()):
+        """
+        Checks that two decoded records have the same attributes, of the
+        same types, holding the same values.
+        """
+        self.assertEqual(sorted(a.__dict__.keys()), sorted(b.__dict__.keys()))
+        for name, value in a.__dict__.items():
+            if name in ignore:
+                continue
+            other = b.__dict__[name]
+            self.assertEqual(type(value), type(other), name)
+            if isinstance(value, (np.ndarray, np.void)):
+                self.assertEqual(value.dtype.names, other.dtype.names, name)
+                np.testing.assert_equal(value.tolist(), other.tolist(), name)
+            else:
+                self.assertEqual(value, other, name)
+                
+    def test_mmap_matches_file(self):
+        infile = par.allRead(self.filename)
+        infile.mapfile()
+        mapped = par.allRead(self.filename, use_mmap = True)
+        mapped.mapfile()
+        for key in infile.map.packdir.keys():
+            for n in range(len(infile.map.packdir[key])):
+                infile.getrecord(key, n)
+                mapped.getrecord(key, n)
+                self.assertSameRecord(infile.packet.subpack, mapped.packet.subpack)
+        infile.close()
+        mapped.close()
+        
+    def test_network_attitude_offsets(self):
+        # a datagram whose first entry has the longest input runs past the end
+        # of the data if the entries are taken to be evenly spaced
+        entries = [(0, 200), (10, 0), (20, 3)]
+        data = ''.join([struct.pack('<HhhhHB', t, 0, 0, 0, 0, n) + 'x' * n
+            for t, n in entries])
+        data = np.frombuffer(data * 2, dtype = np.uint8)
+        start = [0, len(data) // 2]
+        expected = par.Data110.entry_offsets(data, 0, 3) + \
+            par.Data110.entry_offsets(data, start[1], 3)
+        np.testing.assert_array_equal(par.Data110.find_offsets(data, start, [3, 3]),
+            expected)
+        np.testing.assert_array_equal(par.Data110.find_offsets(data, start, [0, 0]), [])
+        
+    def test_network_attitude_bulk(self):
+        reader = par.allRead(self.filename)
+        reader.mapfile()
+        parts = []
+        for n in range(len(reader.map.packdir['110'])):
+            reader.getrecord(110, n)
+            parts.append(reader.packet.subpack.data)
+        np.testing.assert_array_equal(reader.get_all(110), np.concatenate(parts))
+        reader.close()
+        
+    def test_byte_orders_match(self):
+        bigname = os.path.join(self.tempdir, 'big.all')
+        synthetic.write(bigname, e = '>')
+        for use_mmap in [False, True]:
+            little = par.allRead(self.filename, use_mmap = use_mmap)
+            big = par.allRead(bigname, use_mmap = use_mmap)
+            self.assertFalse(little.byteswap)
+            self.assertTrue(big.byteswap)
+            little.mapfile()
+            big.mapfile()
+            for key in little.map.packdir.keys():
+                np.testing.assert_array_equal(little.map.packdir[key][:,1],
+                    big.map.packdir[key][:,1])
+            for t in [65, 71, 80, 110]:
+                a = little.get_all(t)
+                b = big.get_all(t)
+                self.assertEqual(a.dtype.names, b.dtype.names)
+                np.testing.assert_equal(a.tolist(), b.tolist())
+            for t in [78, 88, 107]:
+                for n in range(len(little.map.packdir[str(t)])):
+                    little.getrecord(t, n)
+                    big.getrecord(t, n)
+                    self.assertSameRecord(little.packet.subpack, big.packet.subpack,
+                        ignore = ['byteswap'])
+            little.close()
+            big.close()
+        
+    def sequence(self, reader):
+        """
+        Returns the type, time and following file position of each record
+        found by a mix of getrecord, read and findpacket.
+        """
+        found = []
+        def note():
+            found.append((reader.packet.dtype, reader.packet.time, reader.infile.tell()))
+        for recordtype, recordnum in [(80, 3), (78, 0), (80, 3), (107, 5), (78, 0)]:
+            reader.getrecord(recordtype, recordnum)
+            note()
+            reader.read()
+            note()
+            reader.findpacket(80)
+            note()
+        while not reader.eof:
+            reader.read()
+        reader.getrecord(80, 3)
+        reader.read()
+        note()
+        return found
+        
+    def test_cached_getrecord_position(self):
+        for use_mmap in [False, True]:
+            uncached = par.allRead(self.filename, use_mmap = use_mmap)
+            uncached.mapfile()
+            cached = par.allRead(self.filename, use_mmap = use_mmap, cachesize = 10**7)
+            cached.mapfile()
+            self.assertEqual(self.sequence(cached), self.sequence(uncached))
+            uncached.close()
+            cached.close()
+            
+            
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+"""
+Tests of resolve_file_depths.resolve_all_pings.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import par
+import synthetic
+
+
+class ResolveAllPingsTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'test.all')
+        synthetic.write(self.filename, seconds = 15)
+        self.resolver = par.resolve_file_depths(self.filename)
+        
+    def tearDown(self):
+        self.resolver.p.close()
+        shutil.rmtree(self.tempdir)
+        
+    def resolve(self, name, nproc, blocksize):
+        outname = os.path.join(self.tempdir, name)
+        outputs = self.resolver.resolve_all_pings(outname = outname, nproc = nproc,
+            blocksize = blocksize, verbose = False)
+        return [np.array(out) for out in outputs]
+        
+    def test_nproc_matches_single_process(self):
+        single = self.resolve('single', 1, 7)
+        self.assertEqual(single[0].shape, (30, 32))
+        self.assertFalse(np.isnan(single[3]).all())
+        for nproc, blocksize in [(2, 7), (3, 4), (2, 100)]:
+            pooled = self.resolve('pool%d_%d' % (nproc, blocksize), nproc, blocksize)
+            for a, b in zip(single, pooled):
+                np.testing.assert_array_equal(a, b)
+                
+    def test_outputs_reopen(self):
+        outputs = self.resolve('out', 2, 5)
+        for name, out in zip(['time', 'x', 'y', 'depth'], outputs):
+            saved = np.load(os.path.join(self.tempdir, 'out_' + name + '.npy'))
+            np.testing.assert_array_equal(saved, out)
+            
+            
+if __name__ == '__main__':
+    unittest.main()
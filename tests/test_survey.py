@@ -0,0 +1,111 @@
+"""
+Tests of the record searches of par.surveyindex over several files.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import par
+import synthetic
+
+
+class SurveyIndexTest(unittest.TestCase):
+    
+    # start of each file in seconds after midnight; the last overlaps
+    starts = [3600, 3630, 3660, 3645]
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        for n, start in enumerate(self.starts):
+            synthetic.write(os.path.join(self.tempdir, 'f%d.all' % n),
+                seconds = 20, start = start, seed = n)
+        self.survey = par.surveyindex(os.path.join(self.tempdir, '*.all'))
+        
+    def tearDown(self):
+        self.survey.close()
+        shutil.rmtree(self.tempdir)
+        
+    def brute_force(self, types, keep):
+        """
+        Returns the records of the given types in all files for which
+        keep(reader, key) is true, found from a fresh map of each file.
+        """
+        parts = []
+        for filenum, name in enumerate(self.survey.files):
+            reader = par.allRead(name)
+            reader.mapfile()
+            for t in types:
+                records = reader.map.packdir[str(t)]
+                found = np.nonzero(keep(reader, str(t)))[0]
+                part = np.zeros(len(found), dtype = par.surveyindex.record_dtype)
+                part['File'] = filenum
+                part['Type'] = t
+                part['Record'] = found
+                part['Location'] = records[found,0]
+                part['Time'] = records[found,1]
+                parts.append(part)
+            reader.close()
+        return np.concatenate(parts)
+        
+    def assertSameRecords(self, records, expected):
+        self.assertTrue((np.diff(records['Time']) >= 0).all())
+        order = ['Time', 'File', 'Type', 'Record']
+        np.testing.assert_array_equal(np.sort(records, order = order),
+            np.sort(expected, order = order))
+        
+    def test_files_sorted(self):
+        self.assertTrue((np.diff(self.survey.spans[:,0]) > 0).all())
+        
+    def test_getrecords_between(self):
+        t0 = synthetic.EPOCH + 3600
+        for a, b in [(0, 80), (5.2, 31.7), (44, 51), (59.99, 66.3),
+                (-10, -1), (90, 95), (12.6, 12.6), (10.503, 10.503)]:
+            for types in [80, [78, 88], [65, 110, 71]]:
+                keep = lambda reader, key: ((reader.map.packdir[key][:,1] >= t0 + a) &
+                    (reader.map.packdir[key][:,1] <= t0 + b))
+                records = self.survey.getrecords_between(types, t0 + a, t0 + b)
+                expected = self.brute_force(np.atleast_1d(types), keep)
+                self.assertSameRecords(records, expected)
+                
+    def test_getrecords_in_box(self):
+        def inside(reader, key):
+            pos = reader.get_all(80)
+            times = reader.map.packdir[key][:,1]
+            lat = np.interp(times, pos['Time'], pos['Latitude'])
+            lon = np.interp(times, pos['Time'], pos['Longitude'])
+            return ((times >= pos['Time'][0]) & (times <= pos['Time'][-1]) &
+                (lat >= lat0) & (lat <= lat1) & (lon >= lon0) & (lon <= lon1))
+        for lat0, lat1, lon0, lon1 in [(40, 42, -71, -69),
+                (41.0725, 41.0735, -69.9, -69.8), (41.07, 41.08, -69.8535, -69.852),
+                (41.0728, 41.0731, -69.8545, -69.8538), (42, 43, -71, -69)]:
+            for types in [78, [78, 88], 65]:
+                records = self.survey.getrecords_in_box(types, lat0, lat1, lon0, lon1)
+                expected = self.brute_force(np.atleast_1d(types), inside)
+                self.assertSameRecords(records, expected)
+                
+    def test_geoindex_saved_once(self):
+        saved = []
+        save = par.allRead.savefilemap
+        def counting_save(reader, mapfilename = ''):
+            saved.append(reader.infilename)
+            save(reader, mapfilename)
+        par.allRead.savefilemap = counting_save
+        try:
+            self.survey.getrecords_in_box(78, 40, 42, -71, -69)
+        finally:
+            par.allRead.savefilemap = save
+        self.assertEqual(sorted(saved), sorted(self.survey.files))
+        reloaded = par.surveyindex(self.survey.files)
+        for filemap in reloaded.maps:
+            self.assertTrue(filemap.aux.has_key('geo78'))
+        reloaded.close()
+        
+        
+if __name__ == '__main__':
+    unittest.main()